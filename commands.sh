@@ -7,10 +7,10 @@ hp_tmp() {
     echo "  ls   - List contents of the debug pod log directory"
     echo "  k6   - Run k6 load test (args: [mode] [baseline_duration] [duration] [ramp_duration] [anomaly_rate])"
     echo "  cp   - Copy logs from debug pod to local machine"
-    echo "  et   - Extract labeled dataset from logs (args: [traces_log_path] [metrics_log_path] [output_log_path])"
+    echo "  et   - Extract labeled dataset from logs (args: [traces_log_path] [metrics_log_path] [output_log_path] [csv|parquet|arrow])"
     echo "  hu   - Helm uninstall robot-shop"
     echo "  hi   - Helm install robot-shop (args: [version])"
-    echo "  an   - Analyze trace relationships (args: [input_file])"
+    echo "  an   - Analyze trace relationships (args: [input_file or dataset dir])"
 }
 rm_tmp() {
 	kubectl exec -n robot-shop2 -it deployments/debug-deployment -- sh -c 'echo "{}" > /mnt/otel-logs/traces.json; echo "{}" > /mnt/otel-logs/metrics.json'
@@ -44,7 +44,8 @@ et_tmp() {
   TRACES_LOG_PATH=${1:-/Users/ji/OtherProjects/robot-shop/data/traces.json}
   METRICS_LOG_PATH=${2:-/Users/ji/OtherProjects/robot-shop/data/metrics.json}
   OUTPUT_LOG_PATH=${3:-/Users/ji/OtherProjects/robot-shop/data}
-  python3 python-scripts/extract-labeled-dataset.py --traces "$TRACES_LOG_PATH" --metrics "$METRICS_LOG_PATH" --output "$OUTPUT_LOG_PATH"
+  FORMAT=${4:-csv}
+  python3 python-scripts/extract-labeled-dataset.py --traces "$TRACES_LOG_PATH" --metrics "$METRICS_LOG_PATH" --output "$OUTPUT_LOG_PATH" --format "$FORMAT"
 }
 an_tmp() {
   python3 python-scripts/analyze_trace_relationships.py "$1"
@@ -75,7 +76,7 @@ case $1 in
         cp_tmp
         ;;
     et)
-        et_tmp "$2" "$3" "$4"
+        et_tmp "$2" "$3" "$4" "$5"
         ;;
     hu)
         helm_uninstall_tmp
@@ -33,6 +33,7 @@ var (
 	rabbitCloseError chan *amqp.Error
 	rabbitReady      chan bool
 	errorPercent     int
+	recentOrders     *recentIds
 
 	dataCenters = []string{
 		"asia-northeast2",
@@ -110,6 +111,30 @@ func getOrderId(order []byte) string {
 	return id
 }
 
+// The last size order ids seen. Payment's outbox delivers at least once,
+// an order it sends again after a crash is only dispatched once.
+type recentIds struct {
+	seen  map[string]bool
+	order []string
+	next  int
+}
+
+func newRecentIds(size int) *recentIds {
+	return &recentIds{seen: make(map[string]bool, size), order: make([]string, size)}
+}
+
+// add returns false if id was already seen
+func (r *recentIds) add(id string) bool {
+	if len(r.order) == 0 || r.seen[id] {
+		return len(r.order) == 0
+	}
+	delete(r.seen, r.order[r.next])
+	r.order[r.next] = id
+	r.seen[id] = true
+	r.next = (r.next + 1) % len(r.order)
+	return true
+}
+
 func createSpan(headers map[string]interface{}, order string) {
 	// headers is map[string]interface{}
 	// carrier is map[string]string
@@ -255,6 +280,13 @@ func main() {
 	}
 	log.Printf("Error Percent is %d\n", errorPercent)
 
+	// order ids remembered to drop repeats, 0 turns it off
+	dedupSize := 10000
+	if size, err := strconv.Atoi(os.Getenv("DISPATCH_DEDUP_SIZE")); err == nil && size >= 0 {
+		dedupSize = size
+	}
+	recentOrders = newRecentIds(dedupSize)
+
 	// MQ error channel
 	rabbitCloseError = make(chan *amqp.Error)
 
@@ -279,6 +311,10 @@ func main() {
 				log.Printf("Order %s\n", d.Body)
 				log.Printf("Headers %v\n", d.Headers)
 				id := getOrderId(d.Body)
+				if id != "unknown" && !recentOrders.add(id) {
+					log.Printf("Order %s already dispatched\n", id)
+					continue
+				}
 				go createSpan(d.Headers, id)
 			}
 		}
@@ -0,0 +1,51 @@
+import os
+import time
+
+# Catalogue and shipping reference data as a browser would cache it.
+# With CLIENT_CACHE=1 each user keeps what it fetched for
+# CLIENT_CACHE_TTL seconds and then revalidates it with If-None-Match,
+# so a 304 answer costs the shop no body. Off, every call goes to the
+# shop as before.
+CLIENT_CACHE = os.getenv('CLIENT_CACHE', '0') == '1'
+CLIENT_CACHE_TTL = float(os.getenv('CLIENT_CACHE_TTL', 300))
+
+
+class ReferenceCache:
+    def __init__(self, client, enabled=CLIENT_CACHE, ttl=CLIENT_CACHE_TTL):
+        self._client = client
+        self._enabled = enabled
+        self._ttl = ttl
+        # url -> [expires, etag, data]
+        self._entries = {}
+        # in stock products by the products list they came from
+        self._products = None
+        self._in_stock = []
+
+    # decoded JSON body of a GET
+    def get(self, url, headers, name=None):
+        if not self._enabled:
+            return self._client.get(url, headers=headers, name=name).json()
+
+        now = time.monotonic()
+        entry = self._entries.get(url)
+        if entry is not None:
+            if entry[0] > now:
+                return entry[2]
+            if entry[1]:
+                headers = dict(headers, **{'If-None-Match': entry[1]})
+
+        res = self._client.get(url, headers=headers, name=name)
+        if res.status_code == 304 and entry is not None:
+            entry[0] = now + self._ttl
+            return entry[2]
+        data = res.json()
+        self._entries[url] = [now + self._ttl, res.headers.get('ETag'), data]
+        return data
+
+    # Products with stock, worked out again only when the list changes,
+    # which with the cache on is once per TTL
+    def inStock(self, products):
+        if products is not self._products:
+            self._products = products
+            self._in_stock = [item for item in products if item['instock'] != 0]
+        return self._in_stock
@@ -0,0 +1,101 @@
+import os
+import time
+import logging
+
+import gevent
+from locust import events
+from locust.runners import MasterRunner
+
+# How much CPU each load generator process spends on the load, so we
+# know how far a process can be pushed before it, not the shop, is the
+# bottleneck. Locust is one core per process; CPU_BUDGET is the share
+# of that core we are happy to use.
+#
+# Every CPU_REPORT_S seconds, and when Locust quits, each process logs
+# its CPU use, requests per second, CPU per request and the rate it
+# could reach within budget. Workers also send theirs to the master,
+# which logs one line per worker at the end.
+CPU_BUDGET = float(os.getenv('CPU_BUDGET', 0.8))
+CPU_REPORT_S = float(os.getenv('CPU_REPORT_S', 30))
+
+log = logging.getLogger('cpubudget')
+
+
+class CpuBudget:
+    def __init__(self):
+        self.requests = 0
+        self.reset()
+
+    def reset(self):
+        self._cpu = time.process_time()
+        self._wall = time.monotonic()
+        self.requests = 0
+
+    # only requests that reached the shop
+    def on_request(self, response=None, **kwargs):
+        if response is not None:
+            self.requests += 1
+
+    def report(self):
+        cpu = time.process_time() - self._cpu
+        wall = max(time.monotonic() - self._wall, 1e-9)
+        used = cpu / wall
+        rps = self.requests / wall
+        return {
+            'cpu_used': used,
+            'rps': rps,
+            'cpu_ms_per_request': cpu * 1000 / self.requests if self.requests else 0,
+            # requests a second at CPU_BUDGET, assuming cost per request stays the same
+            'rps_at_budget': rps * CPU_BUDGET / used if used > 0 else 0,
+        }
+
+
+def describe(report):
+    text = 'cpu {:.0%} of one core (budget {:.0%}), {:.1f} req/s, {:.2f} ms cpu/request, {:.0f} req/s at budget'.format(
+        report['cpu_used'], CPU_BUDGET, report['rps'], report['cpu_ms_per_request'], report['rps_at_budget'])
+    if report['cpu_used'] > CPU_BUDGET:
+        text += ', OVER BUDGET'
+    return text
+
+
+@events.init.add_listener
+def on_init(environment, **kwargs):
+    if isinstance(environment.runner, MasterRunner):
+        workers = {}
+
+        @environment.events.worker_report.add_listener
+        def on_worker_report(client_id, data, **kwargs):
+            if 'cpu_budget' in data:
+                workers[client_id] = data['cpu_budget']
+
+        @environment.events.quitting.add_listener
+        def on_master_quitting(environment, **kwargs):
+            for client_id, report in sorted(workers.items()):
+                log.info('worker %s %s', client_id, describe(report))
+        return
+
+    budget = CpuBudget()
+    environment.events.request.add_listener(budget.on_request)
+
+    @environment.events.report_to_master.add_listener
+    def on_report_to_master(client_id, data, **kwargs):
+        data['cpu_budget'] = budget.report()
+
+    def reporter():
+        while True:
+            gevent.sleep(CPU_REPORT_S)
+            log.info('%s', describe(budget.report()))
+
+    running = []
+
+    @environment.events.test_start.add_listener
+    def on_test_start(environment, **kwargs):
+        budget.reset()
+        if running:
+            running.pop().kill()
+        if CPU_REPORT_S > 0:
+            running.append(gevent.spawn(reporter))
+
+    @environment.events.quitting.add_listener
+    def on_quitting(environment, **kwargs):
+        log.info('%s', describe(budget.report()))
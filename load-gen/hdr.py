@@ -0,0 +1,89 @@
+import threading
+
+# Log-linear (HDR style) histogram of non-negative integers, used for
+# latency.py, a copy of payment/hdr.py kept in this build context.
+#
+# Values below 128 get a bucket each. Above that every power of two is
+# split into 64 buckets and a value is reported as the middle of its
+# bucket, so it is within 1/128 (0.8%) of what was recorded. Bucket
+# indexes are part of load-gen's .hdr files, keep them stable.
+class HdrHistogram:
+    SUB_BITS = 7
+    SUB_COUNT = 1 << SUB_BITS
+    HALF = SUB_COUNT >> 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # bucket index -> count, only buckets that were hit
+            self.counts = {}
+            self.count = 0
+            self.min = None
+            self.max = 0
+            self.total = 0
+
+    @classmethod
+    def index(cls, value):
+        if value < cls.SUB_COUNT:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS
+        return shift * cls.HALF + (value >> shift)
+
+    @classmethod
+    def value(cls, index):
+        if index < cls.SUB_COUNT:
+            return index
+        shift = index // cls.HALF - 1
+        low = (index - shift * cls.HALF) << shift
+        return low + ((1 << shift) >> 1)
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = self.index(value)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        with other._lock:
+            counts = dict(other.counts)
+            count, low, high, total = other.count, other.min, other.max, other.total
+        with self._lock:
+            for index, c in counts.items():
+                self.counts[index] = self.counts.get(index, 0) + c
+            self.count += count
+            self.total += total
+            if low is not None and (self.min is None or low < self.min):
+                self.min = low
+            self.max = max(self.max, high)
+
+    # values at each quantile, in one pass over the buckets
+    def percentiles(self, quantiles):
+        with self._lock:
+            counts = dict(self.counts)
+            count = self.count
+            high = self.max
+        result = {}
+        if count == 0:
+            return {q: 0 for q in quantiles}
+        targets = sorted(quantiles)
+        seen = 0
+        t = 0
+        for index in sorted(counts):
+            seen += counts[index]
+            while t < len(targets) and seen >= targets[t] * count:
+                result[targets[t]] = min(self.value(index), high)
+                t += 1
+            if t == len(targets):
+                break
+        for q in targets[t:]:
+            result[q] = high
+        return result
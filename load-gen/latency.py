@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import functools
+from contextlib import contextmanager
+from hdr import HdrHistogram
+
+# Latency histograms per endpoint and per journey, so a run can be kept
+# and compared with another one against SLOs.
+#
+# Every request Locust reports goes into an HDR style histogram under
+# "<method> <name>". Journeys are recorded the same way through record():
+# the open model reports "JOURNEY <task>" and "START <task>", the closed
+# model reports "JOURNEY <task>" for tasks marked @journey, and traffic
+# mix runs report "JOURNEY <journey>". They are kept out of Locust's own
+# stats, where they would add to its Aggregated row and request rate as
+# if they were calls to the shop, and printed when the run ends instead.
+# Think time is left out of journey times. Workers send their histograms
+# to the master, which adds them up, so percentiles are exact across the
+# whole run.
+#
+# With LATENCY_OUT=<prefix> the run writes <prefix>.hdr, every bucket
+# compressed, and <prefix>.csv with the percentiles. Then:
+#
+#   python latency.py report run.hdr
+#   python latency.py merge -o all.hdr a.hdr b.hdr
+#   python latency.py compare base.hdr new.hdr --slo slo.json --tolerance 0.1
+#
+# compare exits 1 when a percentile got worse by more than the
+# tolerance or breaks its SLO. The SLO file maps a histogram name or
+# "*" to limits in milliseconds, e.g.
+#   {"*": {"p99": 2000}, "POST /api/payment/pay/[id]": {"p50": 300, "p99": 1000}}
+LATENCY_OUT = os.getenv('LATENCY_OUT')
+
+MAGIC = b'RSHDR1'
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+
+# Microsecond values, see hdr.py for the buckets, and how many of them
+# were failures
+class Histogram(HdrHistogram):
+    def reset(self):
+        super().reset()
+        self.failures = 0
+
+    def record(self, micros, failed=False):
+        super().record(micros)
+        if failed:
+            self.failures += 1
+
+    def merge(self, other):
+        super().merge(other)
+        self.failures += other.failures
+
+    # QUANTILES by name
+    def named_percentiles(self):
+        p = self.percentiles([q for name, q in QUANTILES])
+        return {name: p[q] for name, q in QUANTILES}
+
+    def dump(self):
+        return {'max': self.max, 'failures': self.failures, 'buckets': sorted(self.counts.items())}
+
+    @classmethod
+    def load(cls, data):
+        histogram = cls()
+        for index, count in data['buckets']:
+            histogram.counts[int(index)] = count
+            histogram.count += count
+        histogram.max = data['max']
+        histogram.failures = data.get('failures', 0)
+        return histogram
+
+
+class Histograms(dict):
+    def record(self, name, micros, failed=False):
+        histogram = self.get(name)
+        if histogram is None:
+            histogram = self[name] = Histogram()
+        histogram.record(micros, failed)
+
+    def merge(self, other):
+        for name, histogram in other.items():
+            if name in self:
+                self[name].merge(histogram)
+            else:
+                self[name] = histogram
+
+    def dump(self):
+        return {name: histogram.dump() for name, histogram in self.items()}
+
+    @classmethod
+    def load(cls, data):
+        return cls((name, Histogram.load(h)) for name, h in data.items())
+
+    def write(self, prefix):
+        with open(prefix + '.hdr', 'wb') as f:
+            f.write(MAGIC)
+            f.write(zlib.compress(json.dumps({'unit': 'us', 'histograms': self.dump()}).encode(), 9))
+        with open(prefix + '.csv', 'w') as f:
+            f.write(self.csv())
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError('{} is not a latency histogram file'.format(path))
+        return cls.load(json.loads(zlib.decompress(data[len(MAGIC):]))['histograms'])
+
+    # milliseconds
+    def csv(self):
+        lines = ['name,count,failures,' + ','.join(name + '_ms' for name, q in QUANTILES) + ',max_ms']
+        for name in sorted(self):
+            histogram = self[name]
+            p = histogram.named_percentiles()
+            lines.append('"{}",{},{},{},{:.3f}'.format(name.replace('"', '""'), histogram.count, histogram.failures,
+                         ','.join('{:.3f}'.format(p[q] / 1000) for q, _ in QUANTILES), histogram.max / 1000))
+        return '\n'.join(lines) + '\n'
+
+
+# the histograms of this process, set by setup()
+_histograms = None
+
+# Journey kinds, recorded with record() rather than as Locust requests
+KINDS = ('JOURNEY', 'START')
+
+
+def record(kind, name, seconds, exception=None):
+    if _histograms is not None:
+        _histograms.record('{} {}'.format(kind, name), seconds * 1000000, exception is not None)
+
+
+class ThinkTime:
+    def __init__(self):
+        self.total = 0.0
+
+
+# greenlet local list of the ThinkTimes open in it
+_thinking = None
+
+
+def _open():
+    global _thinking
+    if _thinking is None:
+        # here so the command line needs no gevent
+        from gevent.local import local
+        _thinking = local()
+    if not hasattr(_thinking, 'open'):
+        _thinking.open = []
+    return _thinking.open
+
+
+# Adds up the think() time this greenlet sleeps inside it, for a journey
+# to take out of its time; the service was not being waited on then.
+@contextmanager
+def thinking():
+    tally = ThinkTime()
+    tallies = _open()
+    tallies.append(tally)
+    try:
+        yield tally
+    finally:
+        tallies.remove(tally)
+
+
+# sleep for think time
+def think(seconds):
+    import gevent
+    start = time.perf_counter()
+    gevent.sleep(seconds)
+    slept = time.perf_counter() - start
+    for tally in _open():
+        tally.total += slept
+
+
+# Marks a task as a journey for the closed model, the open model
+# reports its own from the time the task was due.
+def journey(fn):
+    @functools.wraps(fn)
+    def timed(self):
+        # here so the command line needs no locust
+        from openmodel import OpenModel
+        if isinstance(self, OpenModel):
+            return fn(self)
+        start = time.perf_counter()
+        exception = None
+        with thinking() as think:
+            try:
+                return fn(self)
+            except Exception as err:
+                exception = err
+                raise
+            finally:
+                record('JOURNEY', fn.__name__, time.perf_counter() - start - think.total, exception)
+    return timed
+
+
+# events.init listener
+def setup(environment, **kwargs):
+    global _histograms
+    from locust.runners import MasterRunner, WorkerRunner
+    histograms = _histograms = Histograms()
+
+    if isinstance(environment.runner, WorkerRunner):
+        @environment.events.report_to_master.add_listener
+        def on_report_to_master(client_id, data, **kwargs):
+            data['latency'] = histograms.dump()
+            histograms.clear()
+
+    if isinstance(environment.runner, MasterRunner):
+        @environment.events.worker_report.add_listener
+        def on_worker_report(client_id, data, **kwargs):
+            if 'latency' in data:
+                histograms.merge(Histograms.load(data['latency']))
+    else:
+        @environment.events.request.add_listener
+        def on_request(request_type, name, response_time, exception=None, **kwargs):
+            histograms.record('{} {}'.format(request_type, name), response_time * 1000, exception is not None)
+
+    if not isinstance(environment.runner, WorkerRunner):
+        @environment.events.quitting.add_listener
+        def on_quitting(environment, **kwargs):
+            journeys = Histograms((name, h) for name, h in histograms.items() if name.split(' ', 1)[0] in KINDS)
+            if journeys:
+                sys.stdout.write('\nJourney latency\n' + journeys.csv())
+            if LATENCY_OUT:
+                histograms.write(LATENCY_OUT)
+
+    return histograms
+
+
+def compare(base, new, slo, tolerance):
+    failed = False
+    print('{:<50} {:>5} {:>10} {:>10} {:>8}  {}'.format('name', 'q', 'base ms', 'new ms', 'change', ''))
+    for name in sorted(set(base) | set(new)):
+        if name not in new:
+            print('{:<50} missing from new run'.format(name))
+            continue
+        limits = dict(slo.get('*', {}), **slo.get(name, {}))
+        b = base[name].named_percentiles() if name in base else None
+        n = new[name].named_percentiles()
+        for q, _ in QUANTILES:
+            flags = []
+            change = ''
+            if b is not None and b[q]:
+                ratio = n[q] / b[q] - 1
+                change = '{:+.1%}'.format(ratio)
+                if ratio > tolerance:
+                    flags.append('REGRESSION')
+            if q in limits and n[q] / 1000 > limits[q]:
+                flags.append('SLO {}ms'.format(limits[q]))
+            failed = failed or bool(flags)
+            print('{:<50} {:>5} {:>10} {:>10.1f} {:>8}  {}'.format(
+                name[:50], q, '{:.1f}'.format(b[q] / 1000) if b is not None else '-', n[q] / 1000, change, ' '.join(flags)))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency histograms from load-gen runs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    report = commands.add_parser('report', help='percentiles of a run as CSV')
+    report.add_argument('run')
+    merge = commands.add_parser('merge', help='add up runs, e.g. from separate load-gen processes')
+    merge.add_argument('runs', nargs='+')
+    merge.add_argument('-o', '--output', required=True, help='prefix of the merged .hdr and .csv')
+    diff = commands.add_parser('compare', help='diff two runs, exit 1 on regressions or SLO breaches')
+    diff.add_argument('base')
+    diff.add_argument('new')
+    diff.add_argument('--slo', help='JSON file of limits in ms by histogram name or *')
+    diff.add_argument('--tolerance', type=float, default=0.1, help='allowed increase in a percentile, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        sys.stdout.write(Histograms.read(args.run).csv())
+    elif args.command == 'merge':
+        merged = Histograms()
+        for run in args.runs:
+            merged.merge(Histograms.read(run))
+        merged.write(args.output)
+    else:
+        slo = {}
+        if args.slo:
+            with open(args.slo) as f:
+                slo = json.load(f)
+        if compare(Histograms.read(args.base), Histograms.read(args.new), slo, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
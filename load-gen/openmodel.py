@@ -0,0 +1,118 @@
+import os
+import time
+import random
+
+import gevent
+from gevent.pool import Pool
+from locust import constant, events
+
+import latency
+
+# Open model load: journeys start on a schedule of their own, whether or
+# not earlier ones have finished, so a slow shop gets the same arrival
+# rate as a fast one instead of fewer requests (coordinated omission).
+#
+# TARGET_RPS journeys a second are shared out between the tasks by
+# weight and between the Locust users, each user keeping an arrival
+# schedule per task. ARRIVALS=poisson spaces arrivals randomly,
+# constant evenly. The share of each user comes from the runner's target
+# user count; in a distributed run the master's, as a worker's runner only
+# knows its own part. A user runs at most MAX_INFLIGHT journeys at once,
+# past that arrivals start late.
+#
+# Each journey records two histograms, see latency.py:
+#   START   <task>  how late it started against its schedule
+#   JOURNEY <task>  time from when it should have started to its end,
+#                   less the think time slept inside it
+TARGET_RPS = float(os.getenv('TARGET_RPS', 1))
+ARRIVALS = os.getenv('ARRIVALS', 'poisson')
+MAX_INFLIGHT = int(os.getenv('MAX_INFLIGHT', 100))
+
+
+# copies the master's target user count into the options it sends to
+# the workers with each spawn message
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    from locust.runners import MasterRunner
+    if isinstance(environment.runner, MasterRunner) and environment.parsed_options is not None:
+        environment.parsed_options.open_model_users = environment.runner.target_user_count
+
+
+class Arrivals:
+    def __init__(self, name, fn, rate):
+        self.name = name
+        self.fn = fn
+        self._interval = 1.0 / rate
+        # users spawned together should not arrive together
+        self.due = time.time() + random.uniform(0, self._interval)
+
+    def advance(self):
+        if ARRIVALS == 'poisson':
+            self.due += random.expovariate(1.0 / self._interval)
+        else:
+            self.due += self._interval
+
+
+class OpenModel:
+    # task method name -> share of TARGET_RPS, set by openModel()
+    arrival_weights = {}
+
+    def _users(self):
+        options = getattr(self.environment, 'parsed_options', None)
+        users = getattr(options, 'open_model_users', None) or self.environment.runner.target_user_count
+        return max(users or 1, 1)
+
+    def on_start(self):
+        super().on_start()
+        total = float(sum(self.arrival_weights.values()))
+        rate = TARGET_RPS / self._users()
+        self._arrivals = [Arrivals(name, getattr(self, name), rate * weight / total)
+                          for name, weight in self.arrival_weights.items() if weight > 0]
+        self._pool = Pool(MAX_INFLIGHT)
+
+    def on_stop(self):
+        self._pool.kill()
+        super().on_stop()
+
+    def _journey(self, arrival, due):
+        start = time.time()
+        latency.record('START', arrival.name, max(start - due, 0))
+        exception = None
+        # each journey runs in a greenlet of its own, so only its own think time counts
+        with latency.thinking() as think:
+            try:
+                arrival.fn()
+            except Exception as err:
+                exception = err
+                self.environment.events.user_error.fire(user_instance=self, exception=err, tb=err.__traceback__)
+            finally:
+                # a journey that raised counts as failed, as @journey does for the closed model
+                latency.record('JOURNEY', arrival.name, time.time() - due - think.total, exception)
+
+    # the only task, starts each journey when it is due
+    def dispatch(self):
+        arrival = min(self._arrivals, key=lambda a: a.due)
+        wait = arrival.due - time.time()
+        if wait > 0:
+            gevent.sleep(wait)
+        due = arrival.due
+        arrival.advance()
+        # blocks while MAX_INFLIGHT journeys are running, which
+        # shows up as START lag rather than a lower arrival rate
+        self._pool.spawn(self._journey, arrival, due)
+
+
+# Open model version of a closed model User class, running its task
+# methods named in weights on arrival schedules instead of wait_time
+def openModel(user_class, weights):
+    attrs = {
+        '__module__': user_class.__module__,
+        'wait_time': constant(0),
+        'arrival_weights': weights,
+    }
+    # FastHttpUser connections, one per journey in flight
+    if hasattr(user_class, 'concurrency'):
+        attrs['concurrency'] = MAX_INFLIGHT
+    cls = type('Open' + user_class.__name__, (OpenModel, user_class), attrs)
+    cls.tasks = [OpenModel.dispatch]
+    return cls
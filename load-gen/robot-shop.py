@@ -1,12 +1,31 @@
 import os
 import random
 
-from locust import HttpUser, task, between
+from locust import HttpUser, task, between, events
+from locust.contrib.fasthttp import FastHttpUser
 from random import choice
 from random import randint
+from openmodel import openModel
+from clientcache import ReferenceCache
+from scenario import TrafficMix, MixJourneys
+# logs load-gen CPU use per process
+import cpubudget
+# latency histograms per endpoint and journey, see LATENCY_OUT
+import latency
+from latency import journey
+
+# closed: each user runs a task, waits, runs another, see wait_time
+# open: tasks start at TARGET_RPS whatever the response times, see openmodel.py
+LOAD_MODEL = os.getenv('LOAD_MODEL', 'closed')
+# http: requests based client, prints each step
+# fast: geventhttpclient based client, silent, for high request rates
+LOAD_CLIENT = os.getenv('LOAD_CLIENT', 'http')
+# file of weighted journeys to run instead of the tasks below, see traffic-mix.yaml
+TRAFFIC_MIX = os.getenv('TRAFFIC_MIX')
 
 class UserBehavior(HttpUser):
     wait_time = between(2, 10)
+    verbose = True
 
     # source: https://tools.tracemyip.org/search--ip/list
     fake_ip_addresses = [
@@ -28,9 +47,16 @@ class UserBehavior(HttpUser):
 
     def on_start(self):
         """ on_start is called when a Locust start before any task is scheduled """
-        print('Starting')
+        self.say('Starting')
+        # catalogue and shipping data, cached when CLIENT_CACHE=1
+        self.reference = ReferenceCache(self.client)
+
+    def say(self, msg):
+        if self.verbose:
+            print(msg)
 
     @task
+    @journey
     def login(self):
         fake_ip = random.choice(self.fake_ip_addresses)
 
@@ -39,60 +65,118 @@ class UserBehavior(HttpUser):
                 'password': 'password'
                 }
         res = self.client.post('/api/user/login', json=credentials, headers={'x-forwarded-for': fake_ip})
-        print('login {}'.format(res.status_code))
+        self.say('login {}'.format(res.status_code))
 
 
     @task
+    @journey
     def load(self):
         fake_ip = random.choice(self.fake_ip_addresses)
 
         self.client.get('/', headers={'x-forwarded-for': fake_ip})
         user = self.client.get('/api/user/uniqueid', headers={'x-forwarded-for': fake_ip}).json()
         uniqueid = user['uuid']
-        print('User {}'.format(uniqueid))
+        self.say('User {}'.format(uniqueid))
 
-        self.client.get('/api/catalogue/categories', headers={'x-forwarded-for': fake_ip})
+        self.reference.get('/api/catalogue/categories', {'x-forwarded-for': fake_ip})
         # all products in catalogue
-        products = self.client.get('/api/catalogue/products', headers={'x-forwarded-for': fake_ip}).json()
+        products = self.reference.get('/api/catalogue/products', {'x-forwarded-for': fake_ip})
+        in_stock = self.reference.inStock(products)
+        if not in_stock:
+            self.say('Nothing in stock')
+            return
         for i in range(2):
-            item = None
-            while True:
-                item = choice(products)
-                if item['instock'] != 0:
-                    break
+            item = choice(in_stock)
 
             # vote for item
             if randint(1, 10) <= 3:
-                self.client.put('/api/ratings/api/rate/{}/{}'.format(item['sku'], randint(1, 5)), headers={'x-forwarded-for': fake_ip})
+                self.client.put('/api/ratings/api/rate/{}/{}'.format(item['sku'], randint(1, 5)), name='/api/ratings/api/rate/[sku]/[score]', headers={'x-forwarded-for': fake_ip})
 
-            self.client.get('/api/catalogue/product/{}'.format(item['sku']), headers={'x-forwarded-for': fake_ip})
-            self.client.get('/api/ratings/api/fetch/{}'.format(item['sku']), headers={'x-forwarded-for': fake_ip})
-            self.client.get('/api/cart/add/{}/{}/1'.format(uniqueid, item['sku']), headers={'x-forwarded-for': fake_ip})
+            self.reference.get('/api/catalogue/product/{}'.format(item['sku']), {'x-forwarded-for': fake_ip}, name='/api/catalogue/product/[sku]')
+            self.client.get('/api/ratings/api/fetch/{}'.format(item['sku']), name='/api/ratings/api/fetch/[sku]', headers={'x-forwarded-for': fake_ip})
+            self.client.get('/api/cart/add/{}/{}/1'.format(uniqueid, item['sku']), name='/api/cart/add/[id]/[sku]/1', headers={'x-forwarded-for': fake_ip})
 
-        cart = self.client.get('/api/cart/cart/{}'.format(uniqueid), headers={'x-forwarded-for': fake_ip}).json()
+        cart = self.client.get('/api/cart/cart/{}'.format(uniqueid), name='/api/cart/cart/[id]', headers={'x-forwarded-for': fake_ip}).json()
         item = choice(cart['items'])
-        self.client.get('/api/cart/update/{}/{}/2'.format(uniqueid, item['sku']), headers={'x-forwarded-for': fake_ip})
+        self.client.get('/api/cart/update/{}/{}/2'.format(uniqueid, item['sku']), name='/api/cart/update/[id]/[sku]/2', headers={'x-forwarded-for': fake_ip})
 
         # country codes
-        code = choice(self.client.get('/api/shipping/codes', headers={'x-forwarded-for': fake_ip}).json())
-        city = choice(self.client.get('/api/shipping/cities/{}'.format(code['code']), headers={'x-forwarded-for': fake_ip}).json())
-        print('code {} city {}'.format(code, city))
-        shipping = self.client.get('/api/shipping/calc/{}'.format(city['uuid']), headers={'x-forwarded-for': fake_ip}).json()
+        code = choice(self.reference.get('/api/shipping/codes', {'x-forwarded-for': fake_ip}))
+        city = choice(self.reference.get('/api/shipping/cities/{}'.format(code['code']), {'x-forwarded-for': fake_ip}, name='/api/shipping/cities/[code]'))
+        self.say('code {} city {}'.format(code, city))
+        shipping = self.client.get('/api/shipping/calc/{}'.format(city['uuid']), name='/api/shipping/calc/[uuid]', headers={'x-forwarded-for': fake_ip}).json()
         shipping['location'] = '{} {}'.format(code['name'], city['name'])
-        print('Shipping {}'.format(shipping))
+        self.say('Shipping {}'.format(shipping))
         # POST
-        cart = self.client.post('/api/shipping/confirm/{}'.format(uniqueid), json=shipping, headers={'x-forwarded-for': fake_ip}).json()
-        print('Final cart {}'.format(cart))
+        cart = self.client.post('/api/shipping/confirm/{}'.format(uniqueid), json=shipping, name='/api/shipping/confirm/[id]', headers={'x-forwarded-for': fake_ip}).json()
+        self.say('Final cart {}'.format(cart))
 
-        order = self.client.post('/api/payment/pay/{}'.format(uniqueid), json=cart, headers={'x-forwarded-for': fake_ip}).json()
-        print('Order {}'.format(order))
+        order = self.client.post('/api/payment/pay/{}'.format(uniqueid), json=cart, name='/api/payment/pay/[id]', headers={'x-forwarded-for': fake_ip}).json()
+        self.say('Order {}'.format(order))
 
     @task
+    @journey
     def error(self):
         fake_ip = random.choice(self.fake_ip_addresses)
         if os.environ.get('ERROR') == '1':
-            print('Error request')
+            self.say('Error request')
             cart = {'total': 0, 'tax': 0}
             self.client.post('/api/payment/pay/partner-57', json=cart, headers={'x-forwarded-for': fake_ip})
 
 
+# The same tasks on Locust's geventhttpclient based client, which costs
+# a fraction of the CPU per request, with no printing. Connections are
+# kept alive between requests as with HttpUser.
+class FastUserBehavior(FastHttpUser):
+    wait_time = UserBehavior.wait_time
+    verbose = False
+    fake_ip_addresses = UserBehavior.fake_ip_addresses
+    on_start = UserBehavior.on_start
+    say = UserBehavior.say
+    login = UserBehavior.login
+    load = UserBehavior.load
+    error = UserBehavior.error
+
+
+events.init.add_listener(latency.setup)
+
+
+# Journeys from the TRAFFIC_MIX file, compiled once here
+MIX = None
+if TRAFFIC_MIX:
+    anomaly_rate = os.getenv('ANOMALY_RATE')
+    MIX = TrafficMix.load(TRAFFIC_MIX, float(anomaly_rate) if anomaly_rate else None)
+
+class MixUserBehavior(MixJourneys, HttpUser):
+    mix = MIX
+    tasks = [MixJourneys.journey]
+
+class FastMixUserBehavior(MixJourneys, FastHttpUser):
+    mix = MIX
+    tasks = [MixJourneys.journey]
+
+
+# same tasks at equal weight on arrival schedules,
+# the mix picks its own journeys by weight
+OpenUserBehavior = openModel(UserBehavior, {'login': 1, 'load': 1, 'error': 1})
+OpenFastUserBehavior = openModel(FastUserBehavior, {'login': 1, 'load': 1, 'error': 1})
+OpenMixUserBehavior = openModel(MixUserBehavior, {'journey': 1})
+OpenFastMixUserBehavior = openModel(FastMixUserBehavior, {'journey': 1})
+
+PROFILES = {
+    ('closed', 'http', False): UserBehavior,
+    ('open', 'http', False): OpenUserBehavior,
+    ('closed', 'fast', False): FastUserBehavior,
+    ('open', 'fast', False): OpenFastUserBehavior,
+    ('closed', 'http', True): MixUserBehavior,
+    ('open', 'http', True): OpenMixUserBehavior,
+    ('closed', 'fast', True): FastMixUserBehavior,
+    ('open', 'fast', True): OpenFastMixUserBehavior,
+}
+
+# Locust runs every User class in the file that is not abstract
+def selectProfile(selected):
+    for user_class in PROFILES.values():
+        user_class.abstract = user_class is not selected
+
+selectProfile(PROFILES[(LOAD_MODEL, LOAD_CLIENT, MIX is not None)])
@@ -0,0 +1,240 @@
+import re
+import json
+import math
+import time
+import random
+
+import latency
+
+# Traffic mix read from a JSON or YAML file: weighted user journeys,
+# think times, the share of journeys run as labelled anomalies and the
+# headers sent to each endpoint. The file is read and compiled once;
+# a journey then only samples numbers and formats its URLs.
+# See traffic-mix.yaml for the format.
+
+# labels sent with every request, as k6-scripts/deep-trace-scenarios.js does
+ANOMALY_HEADERS = ('x-anomaly-type', 'x-anomaly-root-cause', 'x-anomaly-label', 'x-anomaly-msg')
+
+
+# Seconds to wait, from a number or a spec:
+#   0.5                 fixed
+#   fixed:0.5           fixed
+#   uniform:1:3         uniform between 1 and 3
+#   randint:2:5         whole seconds from 2 to 5, like k6 randomIntBetween
+#   exponential:2       exponential with a mean of 2
+#   lognormal:1:0.5     lognormal with a median of 1 and sigma 0.5
+def sampler(spec):
+    if spec is None:
+        return None
+    if isinstance(spec, (int, float)):
+        return (lambda: float(spec)) if spec > 0 else None
+    parts = str(spec).split(':')
+    try:
+        kind = parts[0]
+        args = [float(p) for p in parts[1:]]
+        if len(parts) == 1:
+            return sampler(float(kind))
+    except ValueError:
+        raise ValueError('invalid think time {}'.format(spec))
+    if kind == 'fixed' and len(args) == 1:
+        return sampler(args[0])
+    if kind == 'uniform' and len(args) == 2:
+        return lambda: random.uniform(args[0], args[1])
+    if kind == 'randint' and len(args) == 2:
+        return lambda: random.randint(int(args[0]), int(args[1]))
+    if kind == 'exponential' and len(args) == 1:
+        return lambda: random.expovariate(1.0 / args[0])
+    if kind == 'lognormal' and len(args) == 2:
+        mu = math.log(args[0])
+        return lambda: random.lognormvariate(mu, args[1])
+    raise ValueError('invalid think time {}'.format(spec))
+
+
+# Per journey values for URL templates:
+#   {int: [1, 10000]}       random whole number, ends included
+#   {choice: [a, b, c]}     one of the list
+# {now} is always there, milliseconds since the epoch
+def variable(spec):
+    if 'int' in spec:
+        low, high = spec['int']
+        return lambda: random.randint(low, high)
+    if 'choice' in spec:
+        values = list(spec['choice'])
+        return lambda: random.choice(values)
+    raise ValueError('invalid variable {}'.format(spec))
+
+
+# status check, 200 | [200, 404] | '<500' | '>=400', default under 400
+def expectation(spec):
+    if spec is None:
+        return lambda status: status < 400
+    if isinstance(spec, int):
+        return lambda status: status == spec
+    if isinstance(spec, list):
+        allowed = frozenset(spec)
+        return lambda status: status in allowed
+    match = re.match(r'^\s*(<|<=|>|>=)\s*(\d+)\s*$', str(spec))
+    if not match:
+        raise ValueError('invalid expect {}'.format(spec))
+    limit = int(match.group(2))
+    return {
+        '<': lambda status: status < limit,
+        '<=': lambda status: status <= limit,
+        '>': lambda status: status > limit,
+        '>=': lambda status: status >= limit,
+    }[match.group(1)]
+
+
+class Anomaly:
+    def __init__(self, type, root_cause='none', label='anomalous', msg='', think=None, weight=1):
+        self.type = type
+        self.weight = weight
+        # extra wait before the journey, e.g. for a latency spike
+        self.think = sampler(think)
+        self.headers = dict(zip(ANOMALY_HEADERS, (type, root_cause, label, msg)))
+
+NORMAL = Anomaly('none', 'none', 'normal', 'baseline healthy traffic')
+
+
+class Step:
+    def __init__(self, spec, mix):
+        self.method = spec.get('method', 'GET').upper()
+        self.path = spec['path']
+        self.templated = '{' in self.path
+        # one stats entry per endpoint, not per id
+        self.name = spec.get('name') or re.sub(r'\{(\w+)\}', r'[\1]', self.path)
+        self.save = spec.get('save')
+        self.think = sampler(spec.get('think'))
+        self.expect = expectation(spec.get('expect'))
+
+        # json: a literal body or $name of a saved response,
+        # json_extra: keys laid over the saved one
+        body = spec.get('json')
+        self.body_var = body[1:] if isinstance(body, str) and body.startswith('$') else None
+        self.body = None if self.body_var else body
+        self.extra = spec.get('json_extra')
+
+        # the headers for each anomaly type, worked out now
+        headers = dict(mix.headers, **spec.get('headers', {}))
+        inject = spec.get('anomaly_headers', mix.injects(self.path))
+        self.headers = {}
+        for anomaly in [NORMAL] + list(mix.anomalies.values()):
+            self.headers[anomaly.type] = dict(headers, **anomaly.headers) if inject else headers
+
+    # False when it had nothing to send, a saved response missing
+    def call(self, client, values, anomaly):
+        body = self.body
+        if self.body_var:
+            body = values.get(self.body_var)
+            if body is None:
+                return False
+            if self.extra:
+                body = dict(body, **self.extra)
+        url = self.path.format(**values) if self.templated else self.path
+        with client.request(self.method, url, name=self.name, headers=self.headers[anomaly.type],
+                            json=body, catch_response=True) as res:
+            # status 0 is a connection error, which no expect lets through
+            if res.error is not None or res.status_code == 0:
+                res.failure(res.error or 'no response')
+            elif self.expect(res.status_code):
+                res.success()
+            else:
+                res.failure('unexpected status {}'.format(res.status_code))
+            if self.save:
+                try:
+                    values[self.save] = res.json()
+                except ValueError:
+                    values[self.save] = None
+        return True
+
+
+class Journey:
+    def __init__(self, name, spec, mix):
+        self.name = name
+        self.weight = float(spec.get('weight', 1))
+        self.steps = [Step(step, mix) for step in spec['steps']]
+        self.think = sampler(spec.get('think', mix.think))
+        self.anomaly_rate = float(spec.get('anomaly_rate', mix.anomaly_rate))
+        names = spec.get('anomalies') or list(mix.anomalies)
+        self.anomalies = [mix.anomalies[n] for n in names]
+        self._anomaly_weights = list(_cumulative(a.weight for a in self.anomalies))
+
+    def anomaly(self):
+        if self.anomalies and random.random() < self.anomaly_rate:
+            return random.choices(self.anomalies, cum_weights=self._anomaly_weights)[0]
+        return NORMAL
+
+
+def _cumulative(weights):
+    total = 0.0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+class TrafficMix:
+    def __init__(self, spec, anomaly_rate=None):
+        self.headers = dict(spec.get('headers', {}))
+        self._inject = spec.get('anomaly_headers', True)
+        self.think = spec.get('think')
+        self.anomaly_rate = float(anomaly_rate if anomaly_rate is not None else spec.get('anomaly_rate', 0))
+        self.anomalies = {name: Anomaly(name, **fields) for name, fields in spec.get('anomalies', {}).items()}
+        self.variables = {name: variable(v) for name, v in spec.get('variables', {}).items()}
+        self.journeys = [Journey(name, j, self) for name, j in spec['journeys'].items()]
+        self._weights = list(_cumulative(j.weight for j in self.journeys))
+
+    @classmethod
+    def load(cls, path, anomaly_rate=None):
+        with open(path) as f:
+            if path.endswith(('.yaml', '.yml')):
+                import yaml
+                spec = yaml.safe_load(f)
+            else:
+                spec = json.load(f)
+        return cls(spec, anomaly_rate)
+
+    # anomaly_headers is true, false or a list of path prefixes
+    def injects(self, path):
+        if isinstance(self._inject, list):
+            return any(path.startswith(prefix) for prefix in self._inject)
+        return bool(self._inject)
+
+    def pick(self):
+        return random.choices(self.journeys, cum_weights=self._weights)[0]
+
+    # runs one journey, returns the think time to wait after it;
+    # the think times inside it are not counted in journey times
+    def run(self, client, journey=None):
+        journey = journey or self.pick()
+        anomaly = journey.anomaly()
+        if anomaly.think:
+            latency.think(anomaly.think())
+        values = {name: gen() for name, gen in self.variables.items()}
+        values['now'] = int(time.time() * 1000)
+        for step in journey.steps:
+            if step.call(client, values, anomaly) and step.think:
+                latency.think(step.think())
+        return journey.think() if journey.think else 0
+
+
+# User mixin running the journeys of mix, each followed by its think time
+class MixJourneys:
+    mix = None
+    _think = 0
+
+    def wait_time(self):
+        return self._think
+
+    # reported as JOURNEY <name> whichever load model runs it
+    def journey(self):
+        journey = self.mix.pick()
+        start = time.perf_counter()
+        exception = None
+        with latency.thinking() as think:
+            try:
+                self._think = self.mix.run(self.client, journey)
+            except Exception as err:
+                exception = err
+                raise
+            finally:
+                latency.record('JOURNEY', journey.name, time.perf_counter() - start - think.total, exception)
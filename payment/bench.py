@@ -0,0 +1,275 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from delay import Delay
+from hdr import HdrHistogram
+
+# Benchmark for /pay/<id> with no cluster. user, cart and the payment
+# gateway are served by one fake HTTP server in this process and orders
+# go to a fake publisher, each with its own latency and error settings.
+# Requests are sent at a fixed arrival rate and timed from when they
+# were due to start, so a slow service is not hidden by sending less.
+#
+#   python bench.py --rate 200 --duration 30 --gateway-latency lognormal:50:0.5
+#
+# payment.py is loaded in process and called through the Flask test
+# client, or with --url a payment service already running elsewhere is
+# driven over HTTP (it should have USER_HOST, CART_HOST and
+# PAYMENT_GATEWAY pointing at this server). The service reads its
+# settings from the environment as usual, e.g. PAYMENT_FANOUT=0.
+
+# user and cart are called on port 8080 whatever the host
+PORT = 8080
+
+CART = {
+    'total': 42.5,
+    'tax': 7.08,
+    'items': [
+        { 'qty': 2, 'sku': 'RED', 'name': 'Robbie', 'price': 10, 'subtotal': 20 },
+        { 'qty': 1, 'sku': 'HAL-1', 'name': 'HAL', 'price': 15.5, 'subtotal': 15.5 },
+        { 'qty': 1, 'sku': 'SHIP', 'name': 'shipping to Earth', 'price': 7, 'subtotal': 7 }
+    ]
+}
+
+
+# the default listen backlog of 5 drops connections well before payment
+# is the bottleneck
+class BackendServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeBackend:
+    def __init__(self, host, downstream, gateway, error_rate, error_status):
+        self.downstream = downstream
+        self.gateway = gateway
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.counts = {}
+        self._lock = threading.Lock()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body in one write, else delayed ACKs add 40ms
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, body=b'OK'):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                self._reply(*backend.route(self.command, self.path))
+
+            do_GET = _handle
+            do_POST = _handle
+            do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = BackendServer((host, PORT), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-backend', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    # returns (status, body)
+    def route(self, method, path):
+        if path.startswith('/gateway'):
+            self._count('gateway')
+            if self.gateway:
+                time.sleep(self.gateway.sample())
+            if random.random() < self.error_rate:
+                return self.error_status, b'gateway error'
+            return 200, b'OK'
+
+        if self.downstream:
+            time.sleep(self.downstream.sample())
+        if method == 'GET' and path.startswith('/check/'):
+            self._count('user_check')
+            # ids starting anon are unknown users, no order history
+            return (404, b'user not found') if path.startswith('/check/anon') else (200, b'OK')
+        if method == 'POST' and path.startswith('/order/'):
+            self._count('order_history')
+            return 200, b'OK'
+        if method == 'DELETE' and path.startswith('/cart/'):
+            self._count('cart_delete')
+            return 200, b'OK'
+        return 404, b'not found'
+
+
+# Stands in for rabbitmq.Publisher, confirms each order after a delay
+class FakePublisher:
+    def __init__(self, delay):
+        self._delay = delay
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def submit(self, msg, headers):
+        json.dumps(msg)
+        if self._delay:
+            time.sleep(self._delay.sample())
+        with self._lock:
+            self.published += 1
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def publish(self, msg, headers):
+        self.submit(msg, headers).result()
+
+    def close(self):
+        pass
+
+
+class Bench:
+    def __init__(self, send, rate, duration, concurrency, anonymous):
+        self._send = send
+        self._rate = rate
+        self._duration = duration
+        self._anonymous = anonymous
+        # user ids unique to this run, so payment's cart hash idempotency, if on,
+        # does not answer them from an earlier run such as the warmup
+        self._run = os.urandom(4).hex()
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench')
+        self._lock = threading.Lock()
+        self.latency = HdrHistogram()
+        self.statuses = {}
+
+    def _one(self, n, due):
+        user = '{}bench-{}-{}'.format('anon' if random.random() < self._anonymous else '', self._run, n)
+        try:
+            status = self._send(user)
+        except Exception:
+            status = 'error'
+        self.latency.record(time.perf_counter_ns() - due)
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def run(self):
+        interval = 1e9 / self._rate
+        start = time.perf_counter_ns()
+        total = int(self._rate * self._duration)
+        for n in range(total):
+            due = start + int(n * interval)
+            wait = due - time.perf_counter_ns()
+            if wait > 0:
+                time.sleep(wait / 1e9)
+            self._pool.submit(self._one, n, due)
+        self._pool.shutdown(wait=True)
+        elapsed = (time.perf_counter_ns() - start) / 1e9
+
+        percentiles = self.latency.percentiles((0.5, 0.99, 0.999))
+        ok = self.statuses.get(200, 0)
+        return {
+            'requests': total,
+            'ok': ok,
+            'statuses': {str(k): v for k, v in self.statuses.items()},
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(ok / elapsed, 1) if elapsed else 0,
+            'p50_ms': percentiles[0.5] / 1e6,
+            'p99_ms': percentiles[0.99] / 1e6,
+            'p999_ms': percentiles[0.999] / 1e6,
+            'max_ms': self.latency.max / 1e6,
+        }
+
+
+def inProcess(args):
+    os.environ['USER_HOST'] = args.bind
+    os.environ['CART_HOST'] = args.bind
+    os.environ['PAYMENT_GATEWAY'] = 'http://{}:{}/gateway'.format(args.bind, PORT)
+    os.environ.pop('OUTBOX_DIR', None)
+    import payment
+    if not args.verbose:
+        payment.app.logger.setLevel(logging.WARNING)
+    payment.publisher = FakePublisher(Delay.parse(args.publish_latency))
+    local = threading.local()
+
+    def send(user):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = payment.app.test_client()
+        return client.post('/pay/' + user, json=CART).status_code
+
+    return send, payment
+
+
+def remote(args):
+    import requests
+    local = threading.local()
+
+    def send(user):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        return session.post('{}/pay/{}'.format(args.url.rstrip('/'), user), json=CART, timeout=30).status_code
+
+    return send, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark payment /pay against fake user, cart, gateway and broker')
+    parser.add_argument('--rate', type=float, default=100, help='requests per second to send')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send for')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds to send before measuring')
+    parser.add_argument('--concurrency', type=int, default=64, help='most requests in flight')
+    parser.add_argument('--anonymous', type=float, default=0.0, help='fraction of requests from unknown users')
+    parser.add_argument('--downstream-latency', default='0', help='user and cart latency, delay spec in ms')
+    parser.add_argument('--gateway-latency', default='0', help='gateway latency, delay spec in ms')
+    parser.add_argument('--gateway-error-rate', type=float, default=0.0, help='fraction of gateway calls that fail')
+    parser.add_argument('--gateway-error-status', type=int, default=503, help='status of a failed gateway call')
+    parser.add_argument('--publish-latency', default='0', help='broker confirm latency, delay spec in ms')
+    parser.add_argument('--bind', default='127.0.0.1', help='address of the fake backend, port is always 8080')
+    parser.add_argument('--url', help='payment service to drive instead of loading payment.py')
+    parser.add_argument('--verbose', action='store_true', help='keep payment INFO logs')
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.bind, Delay.parse(args.downstream_latency), Delay.parse(args.gateway_latency),
+                          args.gateway_error_rate, args.gateway_error_status)
+    backend.start()
+
+    send, service = remote(args) if args.url else inProcess(args)
+
+    if args.warmup > 0:
+        Bench(send, args.rate, args.warmup, args.concurrency, args.anonymous).run()
+        backend.counts.clear()
+        if service is not None:
+            service.stages.reset()
+            service.publisher.published = 0
+
+    result = Bench(send, args.rate, args.duration, args.concurrency, args.anonymous).run()
+    result['target_rps'] = args.rate
+    result['backend'] = backend.counts
+    if service is not None:
+        result['published'] = service.publisher.published
+        result['stages'] = {name: {k: v for k, v in stage.items() if k in ('count', 'p50_us', 'p99_us', 'p999_us')}
+                            for name, stage in service.stages.report()['stages'].items()}
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+import collections
+import requests
+
+class CircuitOpen(requests.exceptions.RequestException):
+    pass
+
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+STATES = {CLOSED: 'closed', OPEN: 'open', HALF_OPEN: 'half open'}
+
+# Per dependency circuit breaker over the last WINDOW calls. It opens
+# when too many of them failed or were slow, rejects calls straight
+# away for OPEN_S, then lets HALF_OPEN_CALLS trial calls through and
+# closes again only if they all succeed.
+class CircuitBreaker:
+    WINDOW = int(os.getenv('CIRCUIT_WINDOW', 20))
+    MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', 10))
+    FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', 0.5))
+    SLOW_MS = float(os.getenv('CIRCUIT_SLOW_MS', 2000))
+    SLOW_RATE = float(os.getenv('CIRCUIT_SLOW_RATE', 0.8))
+    OPEN_S = float(os.getenv('CIRCUIT_OPEN_S', 10))
+    HALF_OPEN_CALLS = int(os.getenv('CIRCUIT_HALF_OPEN_CALLS', 3))
+
+    def __init__(self, name, logger, state, rejected):
+        self.name = name
+        self._logger = logger
+        self._state_gauge = state.labels(dependency=name)
+        self._rejected = rejected.labels(dependency=name)
+        self._lock = threading.Lock()
+        self._calls = collections.deque()
+        self._failures = 0
+        self._slow = 0
+        self._state = CLOSED
+        self._opened = 0
+        self._trials = 0
+        self._trial_ok = 0
+        self._state_gauge.set(CLOSED)
+
+    def _set(self, state):
+        if state != self._state:
+            self._logger.warning('circuit %s %s -> %s', self.name, STATES[self._state], STATES[state])
+        self._state = state
+        self._state_gauge.set(state)
+        if state == OPEN:
+            self._opened = time.monotonic()
+        elif state == HALF_OPEN:
+            self._trials = 0
+            self._trial_ok = 0
+        else:
+            self._calls.clear()
+            self._failures = 0
+            self._slow = 0
+
+    # Ask to make a call, raises CircuitOpen if it should not be made.
+    # Returns a start time to hand back to after().
+    def before(self):
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened < self.OPEN_S:
+                    self._rejected.inc()
+                    raise CircuitOpen('circuit open for {}'.format(self.name))
+                self._set(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._trials >= self.HALF_OPEN_CALLS:
+                    self._rejected.inc()
+                    raise CircuitOpen('circuit half open for {}'.format(self.name))
+                self._trials += 1
+        return time.monotonic()
+
+    def after(self, start, ok):
+        slow = (time.monotonic() - start) * 1000 >= self.SLOW_MS
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if not ok or slow:
+                    self._set(OPEN)
+                else:
+                    self._trial_ok += 1
+                    if self._trial_ok >= self.HALF_OPEN_CALLS:
+                        self._set(CLOSED)
+                return
+            if self._state == OPEN:
+                return
+
+            self._calls.append((ok, slow))
+            self._failures += not ok
+            self._slow += slow
+            if len(self._calls) > self.WINDOW:
+                old_ok, old_slow = self._calls.popleft()
+                self._failures -= not old_ok
+                self._slow -= old_slow
+            count = len(self._calls)
+            if count >= self.MIN_CALLS and (self._failures / count >= self.FAILURE_RATE
+                                            or self._slow / count >= self.SLOW_RATE):
+                self._set(OPEN)
+
+class Breakers:
+    ENABLED = os.getenv('CIRCUIT_BREAKER', '1') == '1'
+
+    def __init__(self, logger, state, rejected):
+        self._logger = logger
+        self._state = state
+        self._rejected = rejected
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    # None when circuit breaking is turned off
+    def get(self, name):
+        if not self.ENABLED:
+            return None
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = CircuitBreaker(name, self._logger, self._state, self._rejected)
+                    self._breakers[name] = breaker
+        return breaker
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# Bounded LRU map whose entries expire after their TTL
+class TTLCache:
+    def __init__(self, size, ttl):
+        self._size = size
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    # returns (found, value)
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def put(self, key, value, ttl=None):
+        if self._size <= 0:
+            return
+        expires = time.monotonic() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+# Shared between processes, values stored as JSON
+class RedisCache:
+    def __init__(self, url, prefix, ttl):
+        import redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self._prefix = prefix
+        self._ttl = ttl
+
+    def get(self, key):
+        value = self._redis.get(self._prefix + key)
+        if value is None:
+            return False, None
+        return True, json.loads(value)
+
+    def put(self, key, value, ttl=None):
+        ttl = self._ttl if ttl is None else ttl
+        self._redis.set(self._prefix + key, json.dumps(value), ex=max(int(ttl), 1))
+
+# Caches the status of the user service /check call. 200 and 404 are
+# both kept, 404 for the shorter USER_CACHE_NEGATIVE_TTL, anything else
+# is always asked for again. With USER_CACHE_REDIS set, entries are also
+# shared through redis so every worker does not warm its own copy.
+class UserCache:
+    SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+    TTL = float(os.getenv('USER_CACHE_TTL', 60))
+    NEGATIVE_TTL = float(os.getenv('USER_CACHE_NEGATIVE_TTL', 10))
+    REDIS = os.getenv('USER_CACHE_REDIS')
+
+    def __init__(self, logger, hits, misses, shared=True):
+        self._logger = logger
+        self._hits = hits
+        self._misses = misses
+        self._local = TTLCache(self.SIZE, self.TTL)
+        self._shared = None
+        if shared and self.REDIS and self.SIZE > 0:
+            self._shared = RedisCache(self.REDIS, 'payment:user:', self.TTL)
+            self._logger.info('user cache shared through %s', self.REDIS)
+
+    # returns the cached status or None
+    def get(self, id):
+        found, status = self._local.get(id)
+        if not found and self._shared is not None:
+            try:
+                found, status = self._shared.get(id)
+            except Exception as err:
+                self._logger.warning('user cache get failed %s', err)
+            if found:
+                self._local.put(id, status, self._ttl(status))
+        if found:
+            self._hits.inc()
+            return status
+        self._misses.inc()
+        return None
+
+    def put(self, id, status):
+        ttl = self._ttl(status)
+        if ttl is None:
+            return
+        self._local.put(id, status, ttl)
+        if self._shared is not None:
+            try:
+                self._shared.put(id, status, ttl)
+            except Exception as err:
+                self._logger.warning('user cache put failed %s', err)
+
+    def _ttl(self, status):
+        if status == 200:
+            return self.TTL
+        if status == 404:
+            return self.NEGATIVE_TTL
+        return None
@@ -0,0 +1,41 @@
+# Shared by the uwsgi (payment.py) and asyncio (payment_async.py) services
+import os
+from delay import Delay
+
+CART = os.getenv('CART_HOST', 'cart')
+USER = os.getenv('USER_HOST', 'user')
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'https://paypal.com/')
+# see gateway.py
+PAYMENT_GATEWAY_MODE = os.getenv('PAYMENT_GATEWAY_MODE', 'dummy')
+
+# For screenshot demo requirements optionally add in a bit of delay
+# before an order is queued, see delay.py for the spec format.
+# PAYMENT_DELAY_MODE=deferred publishes the order from a background
+# thread once the delay is up instead of sleeping in the request.
+PAYMENT_DELAY = Delay.parse(os.getenv('PAYMENT_DELAY_MS', '0'))
+PAYMENT_DELAY_MODE = os.getenv('PAYMENT_DELAY_MODE', 'sleep')
+
+# the whole cart is only logged for debugging, it is large and on every request
+PAYMENT_LOG_CART = os.getenv('PAYMENT_LOG_CART', '0') == '1'
+
+# /stages and /stages/profile can reset the timers and start a profiler,
+# they are only served when turned on
+PAYMENT_STAGES_API = os.getenv('PAYMENT_STAGES_API', '0') == '1'
+
+# this will blow up if the cart is not valid
+def validCart(cart):
+    has_shipping = False
+    for item in cart.get('items'):
+        if item.get('sku') == 'SHIP':
+            has_shipping = True
+
+    return cart.get('total', 0) != 0 and has_shipping
+
+
+def countItems(items):
+    count = 0
+    for item in items:
+        if item.get('sku') != 'SHIP':
+            count += item.get('qty')
+
+    return count
@@ -0,0 +1,86 @@
+import math
+import heapq
+import random
+import threading
+import time
+
+# Injected latency, parsed once from a spec string.
+# Specs, all values in milliseconds:
+#   250                 fixed 250ms
+#   fixed:250           same as above
+#   uniform:100:500     uniform between 100 and 500
+#   lognormal:200:0.5   lognormal with a median of 200 and sigma 0.5
+class Delay:
+    def __init__(self, kind, a=0.0, b=0.0):
+        self.kind = kind
+        self._a = a
+        self._b = b
+
+    @classmethod
+    def parse(cls, spec):
+        parts = str(spec).strip().split(':')
+        try:
+            if len(parts) == 1:
+                return cls('fixed', float(parts[0]))
+            kind = parts[0]
+            args = [float(p) for p in parts[1:]]
+        except ValueError:
+            raise ValueError('invalid delay spec {}'.format(spec))
+        if kind == 'fixed' and len(args) == 1:
+            return cls(kind, args[0])
+        if kind == 'uniform' and len(args) == 2:
+            return cls(kind, min(args), max(args))
+        if kind == 'lognormal' and len(args) == 2:
+            return cls(kind, math.log(args[0]) if args[0] > 0 else 0.0, args[1])
+        raise ValueError('invalid delay spec {}'.format(spec))
+
+    def __bool__(self):
+        return not (self.kind == 'fixed' and self._a <= 0)
+
+    # seconds to wait
+    def sample(self):
+        if self.kind == 'uniform':
+            ms = random.uniform(self._a, self._b)
+        elif self.kind == 'lognormal':
+            ms = random.lognormvariate(self._a, self._b)
+        else:
+            ms = self._a
+        return max(ms, 0) / 1000
+
+    def __str__(self):
+        if self.kind == 'lognormal':
+            return 'lognormal:{:g}:{:g}'.format(math.exp(self._a), self._b)
+        if self.kind == 'uniform':
+            return 'uniform:{:g}:{:g}'.format(self._a, self._b)
+        return 'fixed:{:g}'.format(self._a)
+
+class Scheduler:
+    # One thread running delayed calls in due order, so delayed work
+    # does not hold a request worker while it waits
+    def __init__(self, logger):
+        self._logger = logger
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = 0
+        self._thread = None
+
+    def schedule(self, delay, fn, *args):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+                self._thread.start()
+            self._seq += 1
+            heapq.heappush(self._queue, (time.monotonic() + delay, self._seq, fn, args))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                _, _, fn, args = heapq.heappop(self._queue)
+            try:
+                fn(*args)
+            except Exception as err:
+                self._logger.error('delayed call failed %s', err)
@@ -0,0 +1,70 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+class SessionPool:
+    # connections kept per downstream host
+    POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+    KEEP_ALIVE = os.getenv('HTTP_KEEP_ALIVE', '1') == '1'
+    CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+    READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+
+    def __init__(self, logger, breakers=None):
+        self._logger = logger
+        self._breakers = breakers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._sessions = {}
+
+    def _session(self, key):
+        with self._lock:
+            # sockets must not be shared with the parent after a fork
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE, pool_block=False)
+                session.mount(key, adapter)
+                if not self.KEEP_ALIVE:
+                    session.headers['Connection'] = 'close'
+                self._sessions[key] = session
+                self._logger.info('new connection pool for %s size %s', key, self.POOL_SIZE)
+        return session
+
+    # Calls are guarded by a circuit breaker per host when breakers are
+    # given, a transport error or 5xx counts against the host.
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
+        parts = urlsplit(url)
+        key = '{}://{}'.format(parts.scheme, parts.netloc)
+        breaker = self._breakers.get(parts.netloc) if self._breakers is not None else None
+        if breaker is None:
+            return self._session(key).request(method, url, **kwargs)
+
+        start = breaker.before()
+        ok = False
+        try:
+            req = self._session(key).request(method, url, **kwargs)
+            ok = req.status_code < 500
+            return req
+        finally:
+            breaker.after(start, ok)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
@@ -0,0 +1,28 @@
+#!/bin/sh
+
+# PAYMENT_SERVER selects how the payment service is run
+#   uwsgi - Flask app under uwsgi, see payment.ini (default)
+#   asgi  - asyncio app under uvicorn, see payment_async.py
+
+PORT=${SHOP_PAYMENT_PORT:-8080}
+
+# values left by a previous run would be added to this one
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]
+then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    chmod 777 "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+case "${PAYMENT_SERVER:-uwsgi}" in
+    uwsgi)
+        exec uwsgi --ini payment.ini
+        ;;
+    asgi)
+        exec uvicorn payment_async:app --host 0.0.0.0 --port $PORT --no-access-log
+        ;;
+    *)
+        echo "Unknown PAYMENT_SERVER $PAYMENT_SERVER, use uwsgi or asgi"
+        exit 1
+        ;;
+esac
@@ -0,0 +1,127 @@
+import os
+import abc
+import random
+import threading
+import time
+import importlib
+from delay import Delay
+
+# Payment gateway clients. authorize() returns the HTTP style status of
+# the payment, 200 meaning accepted, or raises for a transport error.
+# PAYMENT_GATEWAY_MODE picks one:
+#   dummy   GET PAYMENT_GATEWAY on every checkout (default, as before)
+#   probe   a background thread checks PAYMENT_GATEWAY every
+#           PAYMENT_GATEWAY_PROBE_S and checkouts use the last result
+#   stub    no network, latency and failures from PAYMENT_GATEWAY_STUB_*
+#   module:Class  any other Gateway, e.g. a real authorize call
+class Gateway(abc.ABC):
+    # True when authorize() may wait on the network
+    blocking = True
+    # True when authorize() takes the customer's money, so it must not
+    # run for a checkout that fails before it
+    charges = True
+
+    @abc.abstractmethod
+    def authorize(self, id, cart):
+        pass
+
+    def close(self):
+        pass
+
+class DummyGateway(Gateway):
+    charges = False
+
+    def __init__(self, url, http, logger):
+        self._url = url
+        self._http = http
+        self._logger = logger
+
+    def authorize(self, id, cart):
+        req = self._http.get(self._url)
+        self._logger.info('%s returned %s', self._url, req.status_code)
+        return req.status_code
+
+class ProbedGateway(Gateway):
+    INTERVAL = float(os.getenv('PAYMENT_GATEWAY_PROBE_S', 10))
+    charges = False
+
+    def __init__(self, url, http, logger):
+        self._url = url
+        self._http = http
+        self._logger = logger
+        self._status = None
+        self._error = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='gateway-probe', daemon=True).start()
+
+    def _probe(self):
+        try:
+            status = self._http.get(self._url).status_code
+            error = None
+        except Exception as err:
+            status = None
+            error = err
+        if status != self._status or type(error) != type(self._error):
+            self._logger.info('%s probe returned %s', self._url, status if error is None else error)
+        self._status = status
+        self._error = error
+        self._ready.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._probe()
+            self._stop.wait(self.INTERVAL)
+
+    # authorize() waits for the first probe, after that it only reads
+    # the last result, so the asgi handler need not send it to a thread
+    @property
+    def blocking(self):
+        return not self._ready.is_set()
+
+    def authorize(self, id, cart):
+        # only the first checkouts after startup wait for a probe
+        self._ready.wait(self._http.CONNECT_TIMEOUT + self._http.READ_TIMEOUT)
+        if self._error is not None:
+            raise self._error
+        if self._status is None:
+            raise TimeoutError('no answer from gateway probe yet')
+        return self._status
+
+    def close(self):
+        self._stop.set()
+
+class StubGateway(Gateway):
+    LATENCY = Delay.parse(os.getenv('PAYMENT_GATEWAY_STUB_LATENCY_MS', '0'))
+    ERROR_RATE = float(os.getenv('PAYMENT_GATEWAY_STUB_ERROR_RATE', 0))
+    ERROR_STATUS = int(os.getenv('PAYMENT_GATEWAY_STUB_ERROR_STATUS', 503))
+    charges = False
+
+    def __init__(self, url, http, logger):
+        self._logger = logger
+        self.blocking = bool(self.LATENCY)
+        self._logger.info('stub gateway latency %s error rate %s', self.LATENCY, self.ERROR_RATE)
+
+    def authorize(self, id, cart):
+        if self.LATENCY:
+            time.sleep(self.LATENCY.sample())
+        if random.random() < self.ERROR_RATE:
+            return self.ERROR_STATUS
+        return 200
+
+MODES = {
+    'dummy': DummyGateway,
+    'probe': ProbedGateway,
+    'stub': StubGateway,
+}
+
+def makeGateway(mode, url, http, logger):
+    if mode in MODES:
+        cls = MODES[mode]
+    elif ':' in mode:
+        module, name = mode.split(':', 1)
+        cls = getattr(importlib.import_module(module), name)
+    else:
+        raise ValueError('unknown PAYMENT_GATEWAY_MODE {}'.format(mode))
+    logger.info('Payment gateway mode %s', mode)
+    return cls(url, http, logger)
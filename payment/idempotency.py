@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import Future
+from cache import TTLCache
+
+# Remembers the orderid of each successful payment so a retried /pay
+# gets the original answer instead of running the checkout again.
+# The key is the Idempotency-Key header when the client sends one.
+# With IDEMPOTENCY_CART_HASH=1 a request without one is keyed by a hash
+# of the user id and the cart, off by default as it also turns a real
+# second purchase of the same cart into a repeat. A repeat that arrives
+# while the first attempt is still running waits for it to finish.
+class Idempotency:
+    SIZE = int(os.getenv('IDEMPOTENCY_SIZE', 10000))
+    TTL = float(os.getenv('IDEMPOTENCY_TTL', 300))
+    # the same user buying the same cart again is a new order after this
+    CART_TTL = float(os.getenv('IDEMPOTENCY_CART_TTL', 60))
+    CART_HASH = os.getenv('IDEMPOTENCY_CART_HASH', '0') == '1'
+    WAIT = float(os.getenv('IDEMPOTENCY_WAIT_S', 30))
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._done = TTLCache(self.SIZE, self.TTL)
+        self._lock = threading.Lock()
+        self._running = {}
+
+    # None means the request is not deduplicated
+    def key(self, id, cart, header):
+        if self.SIZE <= 0:
+            return None
+        if header:
+            return 'key:{}:{}'.format(id, header)
+        if not self.CART_HASH:
+            return None
+        digest = hashlib.sha256(json.dumps([id, cart], sort_keys=True).encode()).hexdigest()
+        return 'cart:' + digest
+
+    # Returns (orderid, running). orderid is set when the key has already
+    # been paid for, running is a Future when another request is paying
+    # for it now, and both are None when the caller should pay and then
+    # call finish().
+    def begin(self, key):
+        with self._lock:
+            found, orderid = self._done.get(key)
+            if found:
+                return orderid, None
+            running = self._running.get(key)
+            if running is not None:
+                return None, running
+            self._running[key] = Future()
+            return None, None
+
+    def finish(self, key, orderid):
+        with self._lock:
+            if orderid is not None:
+                self._done.put(key, orderid, self.CART_TTL if key.startswith('cart:') else self.TTL)
+            running = self._running.pop(key, None)
+        # a waiter may have cancelled it, the payment itself still counts
+        if running is not None and not running.cancelled():
+            running.set_result(orderid)
+
+    # blocking version of begin() for the uwsgi path, returns the
+    # orderid already paid for or None once the caller owns the key
+    def claim(self, key):
+        while True:
+            orderid, running = self.begin(key)
+            if orderid is not None or running is None:
+                return orderid
+            self._logger.info('waiting for payment already in progress')
+            running.result(timeout=self.WAIT)
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Non-blocking log pipeline for the payment service.
+#
+# Request threads only put the LogRecord on a bounded queue, a listener
+# thread formats it as one JSON line and writes it to stdout. Records
+# are formatted lazily: message arguments are merged in the writer, so
+# callers should log with %s style arguments, not str.format().
+#
+#   LOG_FORMAT       json (default) or text
+#   LOG_QUEUE_SIZE   records held before new ones are dropped
+#   LOG_RATE         most INFO/DEBUG records per second per message type
+#   LOG_SAMPLE       fraction kept per message type, e.g.
+#                    "payment for=0.1,cart delete returned=0.01"
+#                    matched on the start of the unformatted message
+QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+RATE = float(os.getenv('LOG_RATE', 0))
+FORMAT = os.getenv('LOG_FORMAT', 'json')
+
+
+def parseSample(spec):
+    sample = []
+    for part in spec.split(','):
+        if '=' in part:
+            prefix, rate = part.rsplit('=', 1)
+            sample.append((prefix.strip(), float(rate)))
+    return sample
+
+SAMPLE = parseSample(os.getenv('LOG_SAMPLE', ''))
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        doc = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            doc['exc'] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.{:03d}Z'.format(int(record.msecs))
+
+# Sampling and a token bucket per message type. The type is the
+# unformatted message, so 'payment for %s' is one type whatever the id.
+# Warnings and errors always pass.
+class RateLimitFilter(logging.Filter):
+    # message types tracked, past this the counts start over, which
+    # bounds the memory of a caller formatting its own messages
+    MAX_TYPES = 1000
+
+    def __init__(self, rate, sample):
+        super().__init__()
+        self._rate = rate
+        self._sample = sample
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._counts = {}
+        self.dropped = 0
+
+    def _fraction(self, msg):
+        for prefix, fraction in self._sample:
+            if msg.startswith(prefix):
+                return fraction
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            return self._allow(str(record.msg))
+
+    def _allow(self, msg):
+        if len(self._counts) >= self.MAX_TYPES and msg not in self._counts:
+            self._counts.clear()
+        if len(self._buckets) >= self.MAX_TYPES and msg not in self._buckets:
+            self._buckets.clear()
+        fraction = self._fraction(msg)
+        if fraction < 1.0:
+            # every Nth record rather than random, cheaper and even
+            count = self._counts.get(msg, 0) + 1
+            self._counts[msg] = count
+            if count * fraction % 1.0 >= fraction:
+                self.dropped += 1
+                return False
+        if self._rate > 0:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(msg, (self._rate, now))
+            tokens = min(self._rate, tokens + (now - last) * self._rate)
+            if tokens < 1:
+                self._buckets[msg] = (tokens, now)
+                self.dropped += 1
+                return False
+            self._buckets[msg] = (tokens - 1, now)
+        return True
+
+# Puts the record on the queue as is, leaving formatting to the writer,
+# and drops it rather than block when the queue is full.
+class LazyQueueHandler(QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# one queue and writer for every logger set up in the process
+_queue = None
+_listener = None
+_lock = threading.Lock()
+
+
+# Route logger through the queue, replacing its own handlers.
+def setupLogging(logger, level=logging.INFO):
+    global _queue, _listener
+    with _lock:
+        if _listener is None:
+            out = logging.StreamHandler(sys.stdout)
+            if FORMAT == 'json':
+                out.setFormatter(JsonFormatter())
+            else:
+                out.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            _queue = queue.Queue(QUEUE_SIZE)
+            _listener = QueueListener(_queue, out, respect_handler_level=False)
+            _listener.start()
+            atexit.register(_listener.stop)
+
+        handler = LazyQueueHandler(_queue)
+        handler.addFilter(RateLimitFilter(RATE, SAMPLE))
+
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+    return handler
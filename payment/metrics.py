@@ -0,0 +1,59 @@
+# Prometheus metrics for the payment service.
+#
+# Metrics live on their own registry rather than the process default.
+# When PROMETHEUS_MULTIPROC_DIR is set (the Dockerfile does) every uwsgi
+# worker writes its values to files there and a scrape adds them up, so
+# the numbers stay right with more than one process. The rendered page is
+# kept for METRICS_CACHE_S so close scrapes do not each walk every file.
+import os
+import time
+import threading
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+MULTIPROC = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+CACHE_S = float(os.getenv('METRICS_CACHE_S', 1))
+
+REGISTRY = CollectorRegistry()
+
+PromMetrics = {}
+PromMetrics['SOLD_COUNTER'] = Counter('sold_count', 'Running count of items sold', registry=REGISTRY)
+PromMetrics['AUS'] = Histogram('units_sold', 'Avergae Unit Sale', buckets=(1, 2, 5, 10, 100), registry=REGISTRY)
+PromMetrics['AVS'] = Histogram('cart_value', 'Avergae Value Sale', buckets=(100, 200, 500, 1000, 2000, 5000, 10000), registry=REGISTRY)
+PromMetrics['USER_CACHE_HITS'] = Counter('user_cache_hits', 'User checks answered from the cache', registry=REGISTRY)
+PromMetrics['USER_CACHE_MISSES'] = Counter('user_cache_misses', 'User checks sent to the user service', registry=REGISTRY)
+PromMetrics['CIRCUIT_STATE'] = Gauge('circuit_state', 'Circuit breaker state, 0 closed 1 open 2 half open', ['dependency'],
+                                     multiprocess_mode='livemax', registry=REGISTRY)
+PromMetrics['CIRCUIT_REJECTED'] = Counter('circuit_rejected', 'Calls failed fast by an open circuit', ['dependency'], registry=REGISTRY)
+# where /pay spends its time, labelled user_check, gateway, publish, order_history, cart_delete
+PromMetrics['DOWNSTREAM'] = Histogram('payment_downstream_seconds', 'Latency of each downstream call made by /pay', ['call'],
+                                      buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10), registry=REGISTRY)
+
+if MULTIPROC:
+    _exposed = CollectorRegistry()
+    multiprocess.MultiProcessCollector(_exposed)
+else:
+    _exposed = REGISTRY
+
+_lock = threading.Lock()
+_cache = (0, b'')
+
+
+def timer(call):
+    return PromMetrics['DOWNSTREAM'].labels(call=call).time()
+
+
+# text exposition of every metric, at most CACHE_S old
+def renderMetrics():
+    global _cache
+    with _lock:
+        rendered, page = _cache
+        if time.monotonic() - rendered >= CACHE_S:
+            page = generate_latest(_exposed)
+            _cache = (time.monotonic(), page)
+    return page
+
+
+# drop a finished worker's live gauges in multiprocess mode
+def processExit():
+    if MULTIPROC:
+        multiprocess.mark_process_dead(os.getpid())
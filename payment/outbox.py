@@ -0,0 +1,246 @@
+import os
+import json
+import threading
+import time
+
+# Append-only, file-backed outbox for orders.
+#
+# Request threads append an order as one JSON line to the current segment
+# file and return once it has been fsynced; fsyncs are shared by every
+# append that arrived in the same FSYNC_MS window. A drainer thread
+# replays segments in order to RabbitMQ and, once the broker has confirmed
+# a batch, moves the marker file past it and removes finished segments.
+# Orders of a batch the broker confirmed while others in it failed are
+# listed in the marker and skipped when the batch is replayed.
+# After a restart only orders beyond the marker are sent again. Delivery
+# is still at least once: a crash between a confirm and the marker write
+# sends that order again, so consumers dedup on orderid (dispatch does).
+#
+# Layout in the outbox directory:
+#   segment-0000000001.log   orders, one JSON line each
+#   marker                   {"segment": n, "offset": bytes, "orderid": last sent,
+#                             "sent": [orderids past offset already confirmed]}
+class Outbox:
+    SEGMENT_BYTES = int(os.getenv('OUTBOX_SEGMENT_BYTES', 16 * 1024 * 1024))
+    FSYNC_MS = int(os.getenv('OUTBOX_FSYNC_MS', 2))
+    DRAIN_BATCH = int(os.getenv('OUTBOX_DRAIN_BATCH', 100))
+    RETRY_DELAY = 1
+
+    def __init__(self, path, publisher, logger):
+        self._path = path
+        self._publisher = publisher
+        self._logger = logger
+        os.makedirs(path, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        # appends up to _failed were not fsynced because of _error
+        self._failed = 0
+        self._error = None
+        self._synced_event = threading.Event()
+
+        segments = self._segments()
+        self._segment = segments[-1] if segments else 1
+        self._repair(self._segment_path(self._segment))
+        self._file = open(self._segment_path(self._segment), 'ab', buffering=0)
+        self._marker = self._read_marker(segments)
+        self._logger.info('outbox %s segment %s marker %s', path, self._segment, self._marker)
+
+        threading.Thread(target=self._sync, name='outbox-sync', daemon=True).start()
+        threading.Thread(target=self._drain, name='outbox-drain', daemon=True).start()
+
+    def _segment_path(self, n):
+        return os.path.join(self._path, 'segment-{:010d}.log'.format(n))
+
+    def _segments(self):
+        return sorted(int(f[8:18]) for f in os.listdir(self._path)
+                      if f.startswith('segment-') and f.endswith('.log'))
+
+    # drop a line left half written by a crash so new appends start clean
+    def _repair(self, path):
+        try:
+            with open(path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                if end != len(data):
+                    self._logger.warning('outbox dropping %s torn bytes from %s', len(data) - end, path)
+                    f.truncate(end)
+        except FileNotFoundError:
+            pass
+
+    def _read_marker(self, segments):
+        try:
+            with open(os.path.join(self._path, 'marker')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segment': segments[0] if segments else 1, 'offset': 0, 'orderid': None, 'sent': []}
+
+    def _write_marker(self, marker):
+        tmp = os.path.join(self._path, 'marker.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(marker, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self._path, 'marker'))
+        self._marker = marker
+
+    # Write the order to disk and wait for it to be fsynced. Raises the
+    # OSError of a failed fsync; the line is still in the segment and may
+    # be sent anyway if a later fsync gets it to disk.
+    def append(self, msg, headers):
+        line = json.dumps({'orderid': msg.get('orderid'), 'msg': msg, 'headers': headers}).encode() + b'\n'
+        with self._cond:
+            self._file.write(line)
+            self._written += 1
+            seq = self._written
+            self._cond.notify_all()
+            while self._synced < seq:
+                if self._failed >= seq:
+                    raise self._error
+                self._cond.wait()
+
+    # Group commit, one fsync for every append waiting in the window.
+    # Only this thread rotates and closes segment files.
+    def _sync(self):
+        while True:
+            with self._cond:
+                while self._written == self._synced:
+                    self._cond.wait()
+            time.sleep(self.FSYNC_MS / 1000)
+            with self._cond:
+                target = self._written
+                fd = self._file.fileno()
+            try:
+                os.fsync(fd)
+            except OSError as err:
+                self._logger.error('outbox fsync failed %s', err)
+                with self._cond:
+                    self._failed = target
+                    self._error = err
+                    self._cond.notify_all()
+                # the waiting appends have failed, wait for new ones
+                with self._cond:
+                    while self._written == target:
+                        self._cond.wait()
+                continue
+            with self._cond:
+                self._synced = target
+                if self._file.tell() >= self.SEGMENT_BYTES:
+                    try:
+                        self._rotate()
+                    except OSError as err:
+                        self._logger.error('outbox rotate of segment %s failed %s', self._segment, err)
+                self._cond.notify_all()
+            self._synced_event.set()
+
+    # called holding the lock, appends made since the last fsync are in
+    # this segment too, so it is synced again before it is closed; a
+    # failure leaves the current segment open for the next attempt
+    def _rotate(self):
+        os.fsync(self._file.fileno())
+        self._synced = self._written
+        new = open(self._segment_path(self._segment + 1), 'ab', buffering=0)
+        self._file.close()
+        self._segment += 1
+        self._file = new
+        # make the new file's directory entry durable too
+        dirfd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self._logger.info('outbox rotated to segment %s', self._segment)
+
+    # Read up to DRAIN_BATCH complete lines from the marker onwards.
+    # Returns (records, segment, offset) where segment/offset is the
+    # position after the last record read.
+    def _read_batch(self):
+        segment = self._marker['segment']
+        offset = self._marker['offset']
+        records = []
+        while len(records) < self.DRAIN_BATCH:
+            try:
+                f = open(self._segment_path(segment), 'rb')
+            except FileNotFoundError:
+                if segment < self._segment:
+                    segment, offset = segment + 1, 0
+                    continue
+                break
+            with f:
+                f.seek(offset)
+                for line in f:
+                    # a torn line is still being written
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        self._logger.error('outbox skipping bad record in segment %s at %s', segment, offset)
+                    offset += len(line)
+                    if len(records) >= self.DRAIN_BATCH:
+                        break
+                at_end = f.read(1) == b''
+            if len(records) < self.DRAIN_BATCH and at_end and segment < self._segment:
+                segment, offset = segment + 1, 0
+                continue
+            break
+        return records, segment, offset
+
+    def _drain(self):
+        # orderids confirmed by the broker but not yet behind the marker
+        sent = set(self._marker.get('sent', []))
+        # orderid -> Future of a publish not confirmed yet, kept across
+        # retries so an order is never queued twice
+        inflight = {}
+        while True:
+            try:
+                self._drain_batch(sent, inflight)
+            except Exception as err:
+                self._logger.error('outbox drain failed %s', err)
+                time.sleep(self.RETRY_DELAY)
+
+    def _drain_batch(self, sent, inflight):
+        records, segment, offset = self._read_batch()
+        if not records:
+            if (segment, offset) != (self._marker['segment'], self._marker['offset']):
+                self._advance(segment, offset, self._marker['orderid'])
+            self._synced_event.wait(1)
+            self._synced_event.clear()
+            return
+
+        for r in records:
+            orderid = r['orderid']
+            future = inflight.get(orderid)
+            # submit again only once the last attempt failed, one that
+            # timed out is still queued and is waited on again
+            if orderid not in sent and (future is None or (future.done() and future.exception() is not None)):
+                inflight[orderid] = self._publisher.submit(r['msg'], r['headers'])
+
+        failed = 0
+        for orderid, future in list(inflight.items()):
+            try:
+                future.result(timeout=self._publisher.CONFIRM_TIMEOUT)
+                sent.add(orderid)
+                del inflight[orderid]
+            except Exception as err:
+                self._logger.error('outbox publish of %s failed %s', orderid, err)
+                failed += 1
+        if failed:
+            # a crash while retrying does not send the confirmed ones again
+            if sent != set(self._marker.get('sent', [])):
+                self._write_marker(dict(self._marker, sent=sorted(sent)))
+            time.sleep(self.RETRY_DELAY)
+            return
+
+        self._advance(segment, offset, records[-1]['orderid'])
+        sent.clear()
+
+    def _advance(self, segment, offset, orderid):
+        previous = self._marker['segment']
+        self._write_marker({'segment': segment, 'offset': offset, 'orderid': orderid, 'sent': []})
+        for n in range(previous, segment):
+            try:
+                os.remove(self._segment_path(n))
+            except FileNotFoundError:
+                pass
@@ -1,39 +1,40 @@
-import random
-
 import os
-import sys
 import time
-import logging
 import uuid
 import json
 import requests
-import traceback
 from flask import Flask
 from flask import Response
 from flask import request
 from flask import jsonify
-from rabbitmq import Publisher
+from rabbitmq import Publisher, PublishError
+from downstream import SessionPool
+from fanout import Fanout
+from delay import Scheduler
+from outbox import Outbox
+from cache import UserCache
+from gateway import makeGateway
+from breaker import Breakers
+from idempotency import Idempotency
+from stages import Stages, STAGES, parseInterval
+from logs import setupLogging
+from checkout import CART, USER, PAYMENT_GATEWAY, PAYMENT_GATEWAY_MODE, PAYMENT_DELAY, PAYMENT_DELAY_MODE, PAYMENT_LOG_CART, PAYMENT_STAGES_API, validCart, countItems
 # Prometheus
-import prometheus_client
-from prometheus_client import Counter, Histogram
+from prometheus_client import CONTENT_TYPE_LATEST
+from metrics import PromMetrics, renderMetrics, processExit, timer
 
 app = Flask(__name__)
-app.logger.setLevel(logging.INFO)
-
-CART = os.getenv('CART_HOST', 'cart')
-USER = os.getenv('USER_HOST', 'user')
-PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'https://paypal.com/')
+# JSON lines written from a background thread, see logs.py
+setupLogging(app.logger)
 
-# Prometheus
-PromMetrics = {}
-PromMetrics['SOLD_COUNTER'] = Counter('sold_count', 'Running count of items sold')
-PromMetrics['AUS'] = Histogram('units_sold', 'Avergae Unit Sale', buckets=(1, 2, 5, 10, 100))
-PromMetrics['AVS'] = Histogram('cart_value', 'Avergae Value Sale', buckets=(100, 200, 500, 1000, 2000, 5000, 10000))
+# per stage timings of /pay, see /stages
+stages = Stages(STAGES)
+stage = stages.stage
 
 
 @app.errorhandler(Exception)
 def exception_handler(err):
-    app.logger.error(str(err))
+    app.logger.error('%s', err)
     return str(err), 500
 
 @app.route('/health', methods=['GET'])
@@ -43,54 +44,110 @@ def health():
 # Prometheus
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    res = []
-    for m in PromMetrics.values():
-        res.append(prometheus_client.generate_latest(m))
+    return Response(renderMetrics(), content_type=CONTENT_TYPE_LATEST)
 
-    return Response(res, mimetype='text/plain')
+
+@app.route('/stages', methods=['GET', 'POST'])
+def stageTimes():
+    if not PAYMENT_STAGES_API:
+        return 'not found', 404
+    report = stages.report()
+    if request.method == 'POST' and request.args.get('reset') == '1':
+        stages.reset()
+    return jsonify(report)
+
+# sampling profiler, POST ?enable=1&interval_ms=5 or ?enable=0, &reset=1 also
+# clears the samples, GET for collapsed stacks
+@app.route('/stages/profile', methods=['GET', 'POST'])
+def stageProfile():
+    if not PAYMENT_STAGES_API:
+        return 'not found', 404
+    if request.method == 'POST':
+        if request.args.get('enable', '1') == '1':
+            interval = parseInterval(request.args.get('interval_ms', 5))
+            if interval is None:
+                return 'interval_ms must be a whole number of ms from 1', 400
+            stages.profiler.start(interval)
+        else:
+            stages.profiler.stop()
+        if request.args.get('reset') == '1':
+            stages.profiler.clear()
+        return jsonify({ 'profiler': stages.profiler.running })
+    return Response(stages.profiler.collapsed(), mimetype='text/plain')
 
 
 @app.route('/pay/<id>', methods=['POST'])
 def pay(id):
-    app.logger.info('payment for {}'.format(id))
-    cart = request.get_json()
-    app.logger.info(cart)
+    with stage('total'):
+        app.logger.info('payment for %s', id)
+        with stage('parse'):
+            cart = request.get_json()
+        if PAYMENT_LOG_CART:
+            app.logger.info('cart %s', cart)
+
+        # a retry of a payment already made gets the same order back
+        key = idempotency.key(id, cart, request.headers.get('Idempotency-Key'))
+        if key is None:
+            return processPayment(id, cart)
 
+        orderid = idempotency.claim(key)
+        if orderid is not None:
+            app.logger.info('repeat payment for %s order %s', id, orderid)
+            return jsonify({ 'orderid': orderid })
+
+        orderid = None
+        try:
+            res = processPayment(id, cart)
+            if isinstance(res, Response) and res.status_code == 200:
+                orderid = res.get_json()['orderid']
+            return res
+        finally:
+            idempotency.finish(key, orderid)
+
+
+def processPayment(id, cart):
     anonymous_user = True
 
     # check user exists
+    user_check = fanout.submit(checkUser, id)
+
+    # check that the cart is valid
+    # this will blow up if the cart is not valid
+    with stage('cart_validation'):
+        valid = validCart(cart)
+
+    # call to payment gateway, see gateway.py
+    # one that only checks the gateway may run alongside the user check,
+    # one that charges waits for it to pass
+    if valid and not gateway.charges:
+        payment = fanout.submit(callGateway, id, cart)
+
     try:
-        req = requests.get('http://{user}:8080/check/{id}'.format(user=USER, id=id))
+        status = user_check.result()
     except requests.exceptions.RequestException as err:
-        app.logger.error(err)
+        app.logger.error('%s', err)
         return str(err), 500
-    if req.status_code == 200:
+    if status == 200:
         anonymous_user = False
 
-    # check that the cart is valid
-    # this will blow up if the cart is not valid
-    has_shipping = False
-    for item in cart.get('items'):
-        if item.get('sku') == 'SHIP':
-            has_shipping = True
-
-    if cart.get('total', 0) == 0 or has_shipping == False:
-        app.logger.warn('cart not valid')
+    if not valid:
+        app.logger.warning('cart not valid')
         return 'cart not valid', 400
 
-    # dummy call to payment gateway, hope they dont object
+    if gateway.charges:
+        payment = fanout.submit(callGateway, id, cart)
     try:
-        req = requests.get(PAYMENT_GATEWAY)
-        app.logger.info('{} returned {}'.format(PAYMENT_GATEWAY, req.status_code))
+        status = payment.result()
     except requests.exceptions.RequestException as err:
-        app.logger.error(err)
+        app.logger.error('%s', err)
         return str(err), 500
-    if req.status_code != 200:
-        return 'payment error', req.status_code
+    if status != 200:
+        return 'payment error', status
 
     # Prometheus
     # items purchased
-    item_count = countItems(cart.get('items', []))
+    with stage('count_items'):
+        item_count = countItems(cart.get('items', []))
     PromMetrics['SOLD_COUNTER'].inc(item_count)
     PromMetrics['AUS'].observe(item_count)
     PromMetrics['AVS'].observe(cart.get('total', 0))
@@ -99,23 +156,22 @@ def pay(id):
     orderid = str(uuid.uuid4())
     queueOrder({ 'orderid': orderid, 'user': id, 'cart': cart })
 
-    # add to order history
+    # add to order history and delete cart
+    if not anonymous_user:
+        history = fanout.submit(addOrderHistory, id, orderid, cart)
+    cart_delete = fanout.submit(deleteCart, id)
+
     if not anonymous_user:
         try:
-            req = requests.post('http://{user}:8080/order/{id}'.format(user=USER, id=id),
-                    data=json.dumps({'orderid': orderid, 'cart': cart}),
-                    headers={'Content-Type': 'application/json'})
-            app.logger.info('order history returned {}'.format(req.status_code))
+            history.result()
         except requests.exceptions.RequestException as err:
-            app.logger.error(err)
+            app.logger.error('%s', err)
             return str(err), 500
 
-    # delete cart
     try:
-        req = requests.delete('http://{cart}:8080/cart/{id}'.format(cart=CART, id=id));
-        app.logger.info('cart delete returned {}'.format(req.status_code))
+        req = cart_delete.result()
     except requests.exceptions.RequestException as err:
-        app.logger.error(err)
+        app.logger.error('%s', err)
         return str(err), 500
     if req.status_code != 200:
         return 'order history update error', req.status_code
@@ -123,34 +179,121 @@ def pay(id):
     return jsonify({ 'orderid': orderid })
 
 
+def checkUser(id):
+    with stage('user_check'):
+        status = userCache.get(id)
+        if status is None:
+            with timer('user_check'):
+                req = http.get('http://{user}:8080/check/{id}'.format(user=USER, id=id))
+            status = req.status_code
+            userCache.put(id, status)
+        return status
+
+
+def callGateway(id, cart):
+    with stage('gateway'), timer('gateway'):
+        return gateway.authorize(id, cart)
+
+
+def addOrderHistory(id, orderid, cart):
+    with stage('order_history'), timer('order_history'):
+        req = http.post('http://{user}:8080/order/{id}'.format(user=USER, id=id),
+                data=json.dumps({'orderid': orderid, 'cart': cart}),
+                headers={'Content-Type': 'application/json'})
+    app.logger.info('order history returned %s', req.status_code)
+    return req
+
+
+def deleteCart(id):
+    with stage('cart_delete'), timer('cart_delete'):
+        req = http.delete('http://{cart}:8080/cart/{id}'.format(cart=CART, id=id))
+    app.logger.info('cart delete returned %s', req.status_code)
+    return req
+
+
 def queueOrder(order):
     app.logger.info('queue order')
 
-    # For screenshot demo requirements optionally add in a bit of delay
-    delay = int(os.getenv('PAYMENT_DELAY_MS', 0))
-    time.sleep(delay / 1000)
-
     headers = {}
-    publisher.publish(order, headers)
+    if PAYMENT_DELAY:
+        delay = PAYMENT_DELAY.sample()
+        if PAYMENT_DELAY_MODE == 'deferred':
+            scheduler.schedule(delay, publishLater, order, headers)
+            return
+        time.sleep(delay)
+
+    with stage('publish'), timer('publish'):
+        if outbox is not None:
+            outbox.append(order, headers)
+        else:
+            publisher.publish(order, headers)
+
+
+# without waiting for the confirm, so one slow broker round trip
+# does not hold up the other delayed orders
+def publishLater(order, headers):
+    if outbox is not None:
+        outbox.append(order, headers)
+        return
 
+    def confirmed(future):
+        if future.exception() is not None:
+            app.logger.error('order %s not published %s', order['orderid'], future.exception())
+
+    try:
+        publisher.submit(order, headers).add_done_callback(confirmed)
+    except PublishError as err:
+        app.logger.error('order %s not published %s', order['orderid'], err)
 
-def countItems(items):
-    count = 0
-    for item in items:
-        if item.get('sku') != 'SHIP':
-            count += item.get('qty')
 
-    return count
+# each uwsgi worker drains its own spool
+def outboxPath(path):
+    try:
+        import uwsgi
+        return os.path.join(path, 'worker-{}'.format(uwsgi.worker_id()))
+    except ImportError:
+        return path
 
 
 # RabbitMQ
 publisher = Publisher(app.logger)
 
+# OUTBOX_DIR spools orders to local disk and a background thread sends
+# them on, so checkout does not wait on the broker and survives it restarting
+outbox = None
+if os.getenv('OUTBOX_DIR'):
+    outbox = Outbox(outboxPath(os.getenv('OUTBOX_DIR')), publisher, app.logger)
+
+# publishes delayed orders when PAYMENT_DELAY_MODE=deferred
+scheduler = Scheduler(app.logger)
+
+# keep-alive connections to user, cart and the gateway,
+# each host behind a circuit breaker so an outage fails fast
+breakers = Breakers(app.logger, PromMetrics['CIRCUIT_STATE'], PromMetrics['CIRCUIT_REJECTED'])
+http = SessionPool(app.logger, breakers)
+
+# dummy call to payment gateway by default, hope they dont object
+gateway = makeGateway(PAYMENT_GATEWAY_MODE, PAYMENT_GATEWAY, http, app.logger)
+
+# user check results, USER_CACHE_SIZE=0 turns it off
+userCache = UserCache(app.logger, PromMetrics['USER_CACHE_HITS'], PromMetrics['USER_CACHE_MISSES'])
+
+# orderids of recent payments by Idempotency-Key or cart
+idempotency = Idempotency(app.logger)
+
+# runs independent downstream calls concurrently when PAYMENT_FANOUT=1
+fanout = Fanout(app.logger)
+
+# uwsgi calls this as a worker shuts down
+try:
+    import uwsgi
+    uwsgi.atexit = processExit
+except ImportError:
+    pass
+
 if __name__ == "__main__":
-    sh = logging.StreamHandler(sys.stdout)
-    sh.setLevel(logging.INFO)
-    fmt = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    app.logger.info('Payment gateway {}'.format(PAYMENT_GATEWAY))
+    app.logger.info('Payment gateway %s', PAYMENT_GATEWAY)
+    app.logger.info('Payment delay %s mode %s', PAYMENT_DELAY, PAYMENT_DELAY_MODE)
     port = int(os.getenv("SHOP_PAYMENT_PORT", "8080"))
-    app.logger.info('Starting on port {}'.format(port))
+    app.logger.info('Starting on port %s', port)
     app.run(host='0.0.0.0', port=port)
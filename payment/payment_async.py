@@ -0,0 +1,300 @@
+import os
+import asyncio
+import uuid
+import httpx
+import requests
+from quart import Quart
+from quart import Response
+from quart import request
+from quart import jsonify
+from rabbitmq_async import AsyncPublisher
+from cache import UserCache
+from downstream import SessionPool
+from gateway import makeGateway
+from breaker import Breakers
+from idempotency import Idempotency
+from stages import Stages, STAGES, parseInterval
+from logs import setupLogging
+from urllib.parse import urlsplit
+from checkout import CART, USER, PAYMENT_GATEWAY, PAYMENT_GATEWAY_MODE, PAYMENT_DELAY, PAYMENT_LOG_CART, PAYMENT_STAGES_API, validCart, countItems
+# Prometheus
+from prometheus_client import CONTENT_TYPE_LATEST
+from metrics import PromMetrics, renderMetrics, timer
+# OpenTelemetry, Quart is not picked up by opentelemetry-instrument
+from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+
+# Same routes as payment.py served from an event loop, so one process
+# can hold many checkouts waiting on downstream services at once.
+# Selected with PAYMENT_SERVER=asgi, see entrypoint.sh
+
+app = Quart(__name__)
+# JSON lines written from a background thread, see logs.py
+setupLogging(app.logger)
+app.asgi_app = OpenTelemetryMiddleware(app.asgi_app)
+
+# per stage timings of /pay, see /stages
+stages = Stages(STAGES)
+stage = stages.stage
+
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+
+http = None
+publisher = AsyncPublisher(app.logger)
+# orderids of recent payments by Idempotency-Key or cart
+idempotency = Idempotency(app.logger)
+# one circuit breaker per downstream host
+breakers = Breakers(app.logger, PromMetrics['CIRCUIT_STATE'], PromMetrics['CIRCUIT_REJECTED'])
+# what a failed downstream call raises
+ERRORS = (httpx.HTTPError, requests.exceptions.RequestException)
+# the dummy gateway call goes through httpx, other modes use gateway.py
+gateway = None
+if PAYMENT_GATEWAY_MODE != 'dummy':
+    gateway = makeGateway(PAYMENT_GATEWAY_MODE, PAYMENT_GATEWAY, SessionPool(app.logger, breakers), app.logger)
+# local only, the redis client would block the event loop
+userCache = UserCache(app.logger, PromMetrics['USER_CACHE_HITS'], PromMetrics['USER_CACHE_MISSES'], shared=False)
+
+
+@app.before_serving
+async def startup():
+    global http
+    http = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=POOL_SIZE),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+    app.logger.info('Payment gateway %s', PAYMENT_GATEWAY)
+    app.logger.info('Payment delay %s', PAYMENT_DELAY)
+
+
+@app.after_serving
+async def shutdown():
+    await http.aclose()
+    await publisher.close()
+    if gateway is not None:
+        gateway.close()
+
+
+@app.errorhandler(Exception)
+async def exception_handler(err):
+    app.logger.error('%s', err)
+    return str(err), 500
+
+@app.route('/health', methods=['GET'])
+async def health():
+    return 'OK'
+
+# Prometheus
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(renderMetrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+@app.route('/stages', methods=['GET', 'POST'])
+async def stageTimes():
+    if not PAYMENT_STAGES_API:
+        return 'not found', 404
+    report = stages.report()
+    if request.method == 'POST' and request.args.get('reset') == '1':
+        stages.reset()
+    return jsonify(report)
+
+# sampling profiler, POST ?enable=1&interval_ms=5 or ?enable=0, &reset=1 also
+# clears the samples, GET for collapsed stacks
+@app.route('/stages/profile', methods=['GET', 'POST'])
+async def stageProfile():
+    if not PAYMENT_STAGES_API:
+        return 'not found', 404
+    if request.method == 'POST':
+        if request.args.get('enable', '1') == '1':
+            interval = parseInterval(request.args.get('interval_ms', 5))
+            if interval is None:
+                return 'interval_ms must be a whole number of ms from 1', 400
+            stages.profiler.start(interval)
+        else:
+            stages.profiler.stop()
+        if request.args.get('reset') == '1':
+            stages.profiler.clear()
+        return jsonify({ 'profiler': stages.profiler.running })
+    return Response(stages.profiler.collapsed(), mimetype='text/plain')
+
+
+@app.route('/pay/<id>', methods=['POST'])
+async def pay(id):
+    with stage('total'):
+        return await idempotentPayment(id)
+
+
+async def idempotentPayment(id):
+    app.logger.info('payment for %s', id)
+    with stage('parse'):
+        cart = await request.get_json()
+    if PAYMENT_LOG_CART:
+        app.logger.info('cart %s', cart)
+
+    # a retry of a payment already made gets the same order back
+    key = idempotency.key(id, cart, request.headers.get('Idempotency-Key'))
+    if key is None:
+        return await processPayment(id, cart)
+
+    while True:
+        orderid, running = idempotency.begin(key)
+        if orderid is not None:
+            app.logger.info('repeat payment for %s order %s', id, orderid)
+            return jsonify({ 'orderid': orderid })
+        if running is None:
+            break
+        # shielded, a timeout here must not cancel the Future the paying request finishes
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(running)), idempotency.WAIT)
+
+    orderid = None
+    try:
+        res = await processPayment(id, cart)
+        if isinstance(res, Response) and res.status_code == 200:
+            orderid = (await res.get_json())['orderid']
+        return res
+    finally:
+        idempotency.finish(key, orderid)
+
+
+async def processPayment(id, cart):
+    anonymous_user = True
+
+    # check user exists
+    user_check = asyncio.ensure_future(checkUser(id))
+
+    # check that the cart is valid
+    # this will blow up if the cart is not valid
+    try:
+        with stage('cart_validation'):
+            valid = validCart(cart)
+    except Exception:
+        user_check.cancel()
+        raise
+
+    # call to payment gateway, see gateway.py
+    # one that only checks the gateway may run alongside the user check,
+    # one that charges waits for it to pass
+    charges = gateway is not None and gateway.charges
+    if valid and not charges:
+        payment = asyncio.ensure_future(callGateway(id, cart))
+
+    try:
+        status = await user_check
+    except ERRORS as err:
+        app.logger.error('%s', err)
+        if valid and not charges:
+            payment.cancel()
+        return str(err), 500
+    if status == 200:
+        anonymous_user = False
+
+    if not valid:
+        app.logger.warning('cart not valid')
+        return 'cart not valid', 400
+
+    if charges:
+        payment = asyncio.ensure_future(callGateway(id, cart))
+    try:
+        status = await payment
+    except ERRORS as err:
+        app.logger.error('%s', err)
+        return str(err), 500
+    if status != 200:
+        return 'payment error', status
+
+    # Prometheus
+    # items purchased
+    with stage('count_items'):
+        item_count = countItems(cart.get('items', []))
+    PromMetrics['SOLD_COUNTER'].inc(item_count)
+    PromMetrics['AUS'].observe(item_count)
+    PromMetrics['AVS'].observe(cart.get('total', 0))
+
+    # Generate order id
+    orderid = str(uuid.uuid4())
+    await queueOrder({ 'orderid': orderid, 'user': id, 'cart': cart })
+
+    # add to order history and delete cart
+    calls = [deleteCart(id)]
+    if not anonymous_user:
+        calls.insert(0, addOrderHistory(id, orderid, cart))
+    results = await asyncio.gather(*calls, return_exceptions=True)
+
+    for res in results:
+        if isinstance(res, ERRORS):
+            app.logger.error('%s', res)
+            return str(res), 500
+        if isinstance(res, Exception):
+            raise res
+
+    req = results[-1]
+    if req.status_code != 200:
+        return 'order history update error', req.status_code
+
+    return jsonify({ 'orderid': orderid })
+
+
+# same circuit breaking as downstream.SessionPool
+async def fetch(method, url, **kwargs):
+    breaker = breakers.get(urlsplit(url).netloc)
+    if breaker is None:
+        return await http.request(method, url, **kwargs)
+
+    start = breaker.before()
+    ok = False
+    try:
+        req = await http.request(method, url, **kwargs)
+        ok = req.status_code < 500
+        return req
+    finally:
+        breaker.after(start, ok)
+
+
+async def checkUser(id):
+    with stage('user_check'):
+        status = userCache.get(id)
+        if status is None:
+            with timer('user_check'):
+                req = await fetch('GET', 'http://{user}:8080/check/{id}'.format(user=USER, id=id))
+            status = req.status_code
+            userCache.put(id, status)
+        return status
+
+
+async def callGateway(id, cart):
+    with stage('gateway'), timer('gateway'):
+        # dummy call to payment gateway, hope they dont object
+        if gateway is None:
+            req = await fetch('GET', PAYMENT_GATEWAY)
+            app.logger.info('%s returned %s', PAYMENT_GATEWAY, req.status_code)
+            return req.status_code
+        if gateway.blocking:
+            return await asyncio.get_running_loop().run_in_executor(None, gateway.authorize, id, cart)
+        return gateway.authorize(id, cart)
+
+
+async def addOrderHistory(id, orderid, cart):
+    with stage('order_history'), timer('order_history'):
+        req = await fetch('POST', 'http://{user}:8080/order/{id}'.format(user=USER, id=id),
+                json={'orderid': orderid, 'cart': cart})
+    app.logger.info('order history returned %s', req.status_code)
+    return req
+
+
+async def deleteCart(id):
+    with stage('cart_delete'), timer('cart_delete'):
+        req = await fetch('DELETE', 'http://{cart}:8080/cart/{id}'.format(cart=CART, id=id))
+    app.logger.info('cart delete returned %s', req.status_code)
+    return req
+
+
+async def queueOrder(order):
+    app.logger.info('queue order')
+
+    # the wait only parks this coroutine, other checkouts carry on
+    if PAYMENT_DELAY:
+        await asyncio.sleep(PAYMENT_DELAY.sample())
+
+    headers = {}
+    with stage('publish'), timer('publish'):
+        await publisher.publish(order, headers)
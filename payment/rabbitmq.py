@@ -1,50 +1,237 @@
 import json
 import pika
 import os
+import collections
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 
+class PublishError(Exception):
+    pass
+
+class ConnectionLost(PublishError):
+    pass
+
+# Publishes orders from its own I/O thread, which owns the connection and
+# keeps heartbeats going while request threads are busy or idle. Request
+# threads hand messages over through a deque, appending under a lock so
+# it stays within PUBLISH_QUEUE_SIZE (the I/O thread pops without one),
+# and get a Future resolved by the broker confirm. Set PUBLISH_BATCH_SIZE
+# above 1 to send in batches on size or every PUBLISH_BATCH_MS.
 class Publisher:
     HOST = os.getenv('AMQP_HOST', 'rabbitmq')
     VIRTUAL_HOST = '/'
     EXCHANGE='robot-shop'
     TYPE='direct'
     ROUTING_KEY = 'orders'
+    HEARTBEAT = int(os.getenv('AMQP_HEARTBEAT', 30))
+    BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', 1))
+    BATCH_MS = int(os.getenv('PUBLISH_BATCH_MS', 20))
+    QUEUE_SIZE = int(os.getenv('PUBLISH_QUEUE_SIZE', 10000))
+    CONFIRM_TIMEOUT = float(os.getenv('PUBLISH_CONFIRM_TIMEOUT', 10))
+    RECONNECT_DELAY = 1
 
     def __init__(self, logger):
         self._logger = logger
         self._params = pika.connection.ConnectionParameters(
             host=self.HOST,
             virtual_host=self.VIRTUAL_HOST,
+            heartbeat=self.HEARTBEAT,
             credentials=pika.credentials.PlainCredentials('guest', 'guest'))
+        self._queue = collections.deque()
+        self._queue_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closing = False
         self._conn = None
         self._channel = None
+        # delivery tag -> Future, waiting for a confirm
+        self._pending = {}
+        self._delivery_tag = 0
+        # why the last connection attempt failed, None once one opens
+        self._unreachable = None
+        # whether a channel is ready, publish() waits on it to retry
+        self._ready = False
+        self._state = threading.Condition()
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+                self._thread.start()
+
+    # I/O thread, everything below runs on the connection's ioloop
+    def _run(self):
+        while not self._closing:
+            self._conn = pika.SelectConnection(self._params,
+                                               on_open_callback=self._on_open,
+                                               on_open_error_callback=self._on_open_error,
+                                               on_close_callback=self._on_close)
+            self._conn.ioloop.start()
+            self._channel = None
+            with self._state:
+                self._ready = False
+            err = self._unreachable or 'connection to broker lost before confirm'
+            self._fail_pending(ConnectionLost(err))
+            self._fail_queued(ConnectionLost(err))
+            if not self._closing:
+                time.sleep(self.RECONNECT_DELAY)
+
+    def _on_open(self, conn):
+        conn.channel(on_open_callback=self._on_channel_open)
+
+    def _on_open_error(self, conn, err):
+        self._logger.error('broker connection failed %r', err)
+        with self._state:
+            self._unreachable = 'broker connection failed {!r}'.format(err)
+            self._state.notify_all()
+        conn.ioloop.stop()
+
+    def _on_close(self, conn, reason):
+        self._logger.info('broker connection closed %s', reason)
+        conn.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_close)
+        channel.exchange_declare(exchange=self.EXCHANGE, exchange_type=self.TYPE, durable=True,
+                                 callback=lambda frame: channel.confirm_delivery(
+                                     ack_nack_callback=self._on_confirm,
+                                     callback=lambda frame: self._on_ready(channel)))
+
+    def _on_channel_close(self, channel, reason):
+        self._channel = None
+        if self._conn.is_open:
+            self._conn.close()
+
+    def _on_ready(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        with self._state:
+            self._unreachable = None
+            self._ready = True
+            self._state.notify_all()
+        self._logger.info('connected to broker')
+        self._tick()
 
-    def _connect(self):
-        if not self._conn or self._conn.is_closed or self._channel is None or self._channel.is_closed:
-            self._conn = pika.BlockingConnection(self._params)
-            self._channel = self._conn.channel()
-            self._channel.exchange_declare(exchange=self.EXCHANGE, exchange_type=self.TYPE, durable=True)
-            self._logger.info('connected to broker')
-
-    def _publish(self, msg, headers):
-        self._channel.basic_publish(exchange=self.EXCHANGE,
-                                    routing_key=self.ROUTING_KEY,
-                                    properties=pika.BasicProperties(headers=headers),
-                                    body=json.dumps(msg).encode())
-        self._logger.info('message sent')
-
-    #Publish msg, reconnecting if necessary.
+    def _tick(self):
+        self._flush()
+        if self._conn.is_open:
+            self._conn.ioloop.call_later(self.BATCH_MS / 1000, self._tick)
+
+    def _flush(self):
+        sent = 0
+        while self._channel is not None and self._channel.is_open:
+            try:
+                body, headers, future = self._queue.popleft()
+            except IndexError:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._channel.basic_publish(exchange=self.EXCHANGE,
+                                        routing_key=self.ROUTING_KEY,
+                                        properties=pika.BasicProperties(headers=headers),
+                                        body=body)
+            self._delivery_tag += 1
+            self._pending[self._delivery_tag] = future
+            sent += 1
+        if sent:
+            self._logger.info('%s messages sent', sent)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = []
+            for tag in self._pending:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future = self._pending.pop(tag, None)
+            if future is None:
+                continue
+            if isinstance(method, pika.spec.Basic.Ack):
+                future.set_result(tag)
+            else:
+                future.set_exception(PublishError('message nacked by broker'))
+
+    def _fail_pending(self, err):
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(err)
+
+    # what is still queued would only wait out CONFIRM_TIMEOUT
+    def _fail_queued(self, err):
+        while True:
+            try:
+                body, headers, future = self._queue.popleft()
+            except IndexError:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(err)
+
+    def _wake(self):
+        conn = self._conn
+        if conn is not None and conn.is_open:
+            try:
+                conn.ioloop.add_callback_threadsafe(self._flush)
+            except Exception:
+                # closing, the next connection flushes it
+                pass
+
+    # Queue msg and return a Future resolved by the broker confirm.
+    # Raises ConnectionLost straight away while the broker is unreachable.
+    def submit(self, msg, headers):
+        self._start()
+        unreachable = self._unreachable
+        if unreachable is not None:
+            raise ConnectionLost(unreachable)
+        body = json.dumps(msg).encode()
+        future = Future()
+        with self._queue_lock:
+            if len(self._queue) >= self.QUEUE_SIZE:
+                raise PublishError('publish buffer full')
+            self._queue.append((body, headers, future))
+            queued = len(self._queue)
+        if queued >= self.BATCH_SIZE:
+            self._wake()
+        return future
+
+    # Wait for the confirm of a submitted message. On timeout the message
+    # is taken out of the queue if it was not sent yet, so the caller's
+    # failure is not followed by a publish when the broker comes back.
+    def wait(self, future):
+        try:
+            return future.result(timeout=self.CONFIRM_TIMEOUT)
+        except FutureTimeout:
+            future.cancel()
+            raise PublishError('no confirm from broker in {}s'.format(self.CONFIRM_TIMEOUT))
+
+    # Publish msg and wait for the broker to confirm it. If the connection
+    # dropped before the confirm, try once more on the next one; while the
+    # broker is unreachable fail straight away.
     def publish(self, msg, headers):
-        if self._channel is None or self._channel.is_closed or self._conn is None or self._conn.is_closed:
-            self._connect()
+        future = self.submit(msg, headers)
         try:
-            self._publish(msg, headers)
-        except (pika.exceptions.ConnectionClosed, pika.exceptions.StreamLostError):
+            self.wait(future)
+        except ConnectionLost:
             self._logger.info('reconnecting to queue')
-            self._connect()
-            self._publish(msg, headers)
+            with self._state:
+                reconnected = self._state.wait_for(lambda: self._ready or self._unreachable is not None,
+                                                   timeout=self.CONFIRM_TIMEOUT)
+            if not reconnected:
+                raise PublishError('broker did not reconnect in {}s'.format(self.CONFIRM_TIMEOUT))
+            self.wait(self.submit(msg, headers))
 
     def close(self):
-        if self._conn and self._conn.is_open:
+        self._closing = True
+        conn = self._conn
+        if conn is not None and conn.is_open:
             self._logger.info('closing queue connection')
-            self._conn.close()
-
+            conn.ioloop.add_callback_threadsafe(lambda: self._flush() or conn.close())
+        if self._thread is not None:
+            self._thread.join(timeout=self.CONFIRM_TIMEOUT)
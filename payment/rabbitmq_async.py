@@ -0,0 +1,54 @@
+import json
+import asyncio
+import aio_pika
+import os
+
+class AsyncPublisher:
+    HOST = os.getenv('AMQP_HOST', 'rabbitmq')
+    VIRTUAL_HOST = '/'
+    EXCHANGE='robot-shop'
+    TYPE=aio_pika.ExchangeType.DIRECT
+    ROUTING_KEY = 'orders'
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._conn = None
+        self._channel = None
+        self._exchange = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._lock:
+            if self._channel is None or self._channel.is_closed:
+                # connect_robust re-establishes the connection and channel by itself
+                if self._conn is None:
+                    self._conn = await aio_pika.connect_robust(
+                        host=self.HOST,
+                        virtualhost=self.VIRTUAL_HOST,
+                        login='guest',
+                        password='guest')
+                self._channel = await self._conn.channel()
+                self._exchange = await self._channel.declare_exchange(self.EXCHANGE, self.TYPE, durable=True)
+                self._logger.info('connected to broker')
+
+    async def _publish(self, msg, headers):
+        await self._exchange.publish(
+            aio_pika.Message(body=json.dumps(msg).encode(), headers=headers),
+            routing_key=self.ROUTING_KEY)
+        self._logger.info('message sent')
+
+    #Publish msg, reconnecting if necessary.
+    async def publish(self, msg, headers):
+        if self._channel is None or self._channel.is_closed:
+            await self._connect()
+        try:
+            await self._publish(msg, headers)
+        except (aio_pika.exceptions.ChannelClosed, aio_pika.exceptions.ConnectionClosed):
+            self._logger.info('reconnecting to queue')
+            await self._connect()
+            await self._publish(msg, headers)
+
+    async def close(self):
+        if self._conn and not self._conn.is_closed:
+            self._logger.info('closing queue connection')
+            await self._conn.close()
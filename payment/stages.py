@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import threading
+import collections
+from contextlib import contextmanager
+from hdr import HdrHistogram
+
+# In-process timing of each stage of the checkout pipeline, cheap enough
+# to leave on for every request. Spans are taken with perf_counter_ns and
+# kept in HDR style histograms, see hdr.py; GET /stages shows the percentiles.
+
+# Samples the stacks of every other thread while turned on and counts
+# them in collapsed stack form, ready for a flame graph.
+class SamplingProfiler:
+    MAX_STACKS = 5000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = collections.Counter()
+        self._thread = None
+        self._stop = None
+        self.interval = 0.005
+
+    @property
+    def running(self):
+        return self._stop is not None
+
+    def start(self, interval_ms=5):
+        with self._lock:
+            self.interval = max(interval_ms, 1) / 1000
+            if self._stop is not None:
+                return
+            # each sampler gets its own stop event, one still finishing
+            # its last pass can not be revived by a later start
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,), name='stage-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            stop, thread = self._stop, self._thread
+            self._stop = self._thread = None
+        if stop is not None:
+            stop.set()
+            thread.join()
+
+    def _run(self, stop):
+        me = threading.get_ident()
+        while not stop.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                with self._lock:
+                    if key in self._stacks or len(self._stacks) < self.MAX_STACKS:
+                        self._stacks[key] += 1
+            stop.wait(self.interval)
+
+    def collapsed(self):
+        with self._lock:
+            lines = ['{} {}'.format(stack, count) for stack, count in self._stacks.most_common()]
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._stacks.clear()
+
+class Stages:
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, names):
+        self._histograms = collections.OrderedDict((name, HdrHistogram()) for name in names)
+        self.profiler = SamplingProfiler()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._histograms[name].record(time.perf_counter_ns() - start)
+
+    # microseconds, for the /stages endpoint
+    def report(self):
+        stages = collections.OrderedDict()
+        for name, histogram in self._histograms.items():
+            percentiles = histogram.percentiles(self.QUANTILES)
+            stages[name] = {
+                'count': histogram.count,
+                'min_us': (histogram.min or 0) / 1000,
+                'mean_us': histogram.total / histogram.count / 1000 if histogram.count else 0,
+                'p50_us': percentiles[0.5] / 1000,
+                'p90_us': percentiles[0.9] / 1000,
+                'p99_us': percentiles[0.99] / 1000,
+                'p999_us': percentiles[0.999] / 1000,
+                'max_us': histogram.max / 1000,
+            }
+        return {'stages': stages, 'profiler': self.profiler.running}
+
+    def reset(self):
+        for histogram in self._histograms.values():
+            histogram.reset()
+
+# interval_ms of POST /stages/profile, None unless a whole number of ms >= 1
+def parseInterval(value):
+    try:
+        interval = int(value)
+    except (TypeError, ValueError):
+        return None
+    return interval if interval >= 1 else None
+
+# stages of /pay/<id> in the order they run
+STAGES = ('total', 'parse', 'user_check', 'cart_validation', 'gateway', 'count_items', 'publish', 'order_history', 'cart_delete')
@@ -18,6 +18,23 @@ import sys
 from pathlib import Path
 from collections import defaultdict, Counter
 
+def load_dataset(path):
+    """Load a dataset written by extract-labeled-dataset.py
+
+    Either a CSV, or a Parquet/Arrow file or directory partitioned by
+    anomaly_type (--format parquet|arrow).
+    """
+    if path.is_file() and path.suffix == '.csv':
+        return pd.read_csv(path, keep_default_na=False)  # Don't convert empty strings to NaN
+
+    import pyarrow.dataset as ds
+    files = [path] if path.is_file() else path.rglob('*.*')
+    fmt = 'ipc' if any(f.suffix in ('.arrow', '.feather') for f in files) else 'parquet'
+    df = ds.dataset(path, format=fmt, partitioning='hive').to_table().to_pandas()
+    if 'anomaly_type' in df.columns:
+        df['anomaly_type'] = df['anomaly_type'].astype('category')
+    return df
+
 def analyze_span_relationships(df):
     """Analyze parent-child relationships between spans"""
     print("=" * 80)
@@ -389,7 +406,9 @@ def visualize_example_traces(df, num_examples=10):
 
                 # Format timestamp
                 try:
-                    ts = datetime.fromisoformat(span['timestamp'])
+                    ts = span['timestamp']
+                    if isinstance(ts, str):
+                        ts = datetime.fromisoformat(ts)
                     time_str = ts.strftime("%H:%M:%S.%f")[:-3]  # milliseconds
                 except:
                     time_str = "unknown"
@@ -440,7 +459,7 @@ def main():
         input_file = Path(sys.argv[1])
     else:
         raise FileNotFoundError(
-            "Usage: python3 analyze_trace_relationships.py <path_to_extracted_dataset.csv>"
+            "Usage: python3 analyze_trace_relationships.py <path_to_extracted_dataset.csv|.parquet|.arrow|dir>"
         )
 
     if not input_file.exists():
@@ -448,7 +467,7 @@ def main():
         sys.exit(1)
 
     print(f"Loading dataset from: {input_file}")
-    df = pd.read_csv(input_file, keep_default_na=False)  # Don't convert empty strings to NaN
+    df = load_dataset(input_file)
 
     print(f"Loaded {len(df):,} rows with {len(df.columns)} columns")
     print(f"Columns: {', '.join(df.columns)}")
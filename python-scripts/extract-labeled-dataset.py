@@ -4,100 +4,230 @@ Extract Labeled Dataset from OpenTelemetry Traces
 Converts JSONL traces with anomaly labels into ML-ready datasets
 """
 
+import os
 import json
+import math
 import sys
+import hashlib
+import time
+import numpy as np
 import pandas as pd
 import argparse
 from pathlib import Path
+from urllib.parse import quote
 from datetime import datetime
-from collections import defaultdict
+from functools import lru_cache
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Span attributes that become columns: key -> (column, value field, default)
+SPAN_ATTRIBUTES = {
+    'http.method': ('http_method', 'stringValue', ''),
+    'http.status_code': ('http_status_code', 'intValue', 0),
+    'http.target': ('http_target', 'stringValue', ''),
+    'http.url': ('http_url', 'stringValue', ''),
+    # Anomaly labels (extracted from custom headers)
+    'anomaly.type': ('anomaly_type', 'stringValue', 'none'),
+    'anomaly.label': ('anomaly_label', 'stringValue', 'normal'),
+    'anomaly.root_cause': ('anomaly_root_cause', 'stringValue', 'none'),
+    'anomaly.msg': ('anomaly_msg', 'stringValue', ''),
+    'net.peer.name': ('net_peer_name', 'stringValue', ''),
+    'net.peer.port': ('net_peer_port', 'intValue', 0),
+    'custom.sdk.tags.datacenter': ('datacenter', 'stringValue', ''),
+}
+# key -> (position in the row's attribute values, value field, default)
+ATTRIBUTE_SLOTS = {key: (i, field, default) for i, (key, (column, field, default)) in enumerate(SPAN_ATTRIBUTES.items())}
+ATTRIBUTE_DEFAULTS = [default for column, field, default in SPAN_ATTRIBUTES.values()]
+
+# What extract_trace_features() returns for each span; timestamp and the
+# durations are worked out a batch at a time by spans_frame()
+ROW_COLUMNS = [
+    'start_time_ns', 'end_time_ns', 'service_name', 'trace_id', 'span_id', 'parent_span_id',
+    'span_name', 'span_kind', 'span_status', 'span_status_message',
+] + [column for column, field, default in SPAN_ATTRIBUTES.values()]
 
 def extract_trace_features(trace):
     """Extract features from all spans in a trace
 
-    Returns a list of feature dicts, one per span in the trace.
+    Returns a list of tuples in ROW_COLUMNS order, one per span in the trace.
     Each span represents a service call in the distributed trace.
     """
-    all_span_features = []
-
-    # Get resource spans - each resourceSpan represents a different service
-    resource_spans = trace.get('resourceSpans', [])
-    if not resource_spans:
-        return []
+    rows = []
 
-    for resource_span in resource_spans:
+    # Each resourceSpan represents a different service
+    for resource_span in trace.get('resourceSpans') or ():
         # Extract service name from resource attributes
-        resource_attrs = resource_span.get('resource', {}).get('attributes', [])
         service_name = 'unknown'
-        for attr in resource_attrs:
+        for attr in resource_span.get('resource', {}).get('attributes', []):
             if attr.get('key') == 'service.name':
                 service_name = attr.get('value', {}).get('stringValue', 'unknown')
                 break
 
-        # Get all spans for this service
-        scope_spans = resource_span.get('scopeSpans', [])
-        if not scope_spans:
-            continue
+        for scope_span in resource_span.get('scopeSpans') or ():
+            for span in scope_span.get('spans', []):
+                # Only the attributes we have columns for, but every one
+                # needs a key and a value or the trace is skipped
+                values = ATTRIBUTE_DEFAULTS.copy()
+                for attr in span.get('attributes', []):
+                    value = attr['value']
+                    slot = ATTRIBUTE_SLOTS.get(attr['key'])
+                    if slot is not None:
+                        values[slot[0]] = value.get(slot[1], slot[2])
+
+                status = span.get('status', {})
+                rows.append((
+                    int(span.get('startTimeUnixNano', 0)),
+                    int(span.get('endTimeUnixNano', 0)),
+                    service_name,
+                    span.get('traceId', ''),  # Same for all spans in this request
+                    span.get('spanId', ''),  # Unique ID for this service call
+                    span.get('parentSpanId', ''),  # Parent service that called this
+                    span.get('name', ''),
+                    span.get('kind', 0),  # 1=Internal, 2=Server, 3=Client, 4=Producer, 5=Consumer
+                    status.get('code', 0),
+                    status.get('message', ''),
+                    *values,
+                ))
+
+    return rows
+
+def msgspec_trace_rows():
+    """extract_trace_features() over msgspec structs of the OTLP shape
+
+    Returns rows(line) or None without msgspec. The structs hold no
+    cycles, so they are left out of garbage collection. Lines that are
+    not valid JSON or do not fit the structs go through json and the
+    dict path, so they give the same rows and warnings as before; that
+    is why attribute keys and values are required and an explicit null
+    value is told apart from a missing one.
+    """
+    try:
+        import msgspec
+    except ImportError:
+        return None
+    from typing import Union
+
+    UNSET = msgspec.UNSET
+
+    class AnyValue(msgspec.Struct, rename='camel', gc=False):
+        string_value: Union[str, None, msgspec.UnsetType] = UNSET
+        int_value: Union[int, str, None, msgspec.UnsetType] = UNSET  # int64 is a string in OTLP JSON
 
-        for scope_span in scope_spans:
-            spans = scope_span.get('spans', [])
+    class KeyValue(msgspec.Struct, gc=False):
+        key: str
+        value: AnyValue
 
-            # Process each span
-            for span in spans:
-                features = {}
+    class Resource(msgspec.Struct, gc=False):
+        attributes: list[KeyValue] = []
 
-                # Timing information - FIRST to have timestamp as first column
-                start_time = int(span.get('startTimeUnixNano', 0))
-                end_time = int(span.get('endTimeUnixNano', 0))
+    class Status(msgspec.Struct, gc=False):
+        code: Union[int, str] = 0
+        message: str = ''
 
-                # Convert nanoseconds to ISO 8601 timestamp for readability
-                from datetime import datetime
-                features['timestamp'] = datetime.fromtimestamp(start_time / 1_000_000_000).isoformat()
-                features['start_time_ns'] = start_time
-                features['end_time_ns'] = end_time
-                features['duration_ns'] = end_time - start_time
-                features['duration_ms'] = features['duration_ns'] / 1_000_000
+    class Span(msgspec.Struct, rename='camel', gc=False):
+        trace_id: str = ''
+        span_id: str = ''
+        parent_span_id: str = ''
+        name: str = ''
+        kind: Union[int, str] = 0
+        start_time_unix_nano: Union[int, str] = 0
+        end_time_unix_nano: Union[int, str] = 0
+        attributes: list[KeyValue] = []
+        status: Status = msgspec.field(default_factory=Status)
 
-                # Service information
-                features['service_name'] = service_name
+    class ScopeSpans(msgspec.Struct, gc=False):
+        spans: list[Span] = []
 
-                # Span identification - CRITICAL for MSA trace analysis
-                features['trace_id'] = span.get('traceId', '')  # Same for all spans in this request
-                features['span_id'] = span.get('spanId', '')     # Unique ID for this service call
-                features['parent_span_id'] = span.get('parentSpanId', '')  # Parent service that called this
+    class ResourceSpans(msgspec.Struct, rename='camel', gc=False):
+        resource: Resource = msgspec.field(default_factory=Resource)
+        scope_spans: list[ScopeSpans] = []
 
-                # Span name and kind
-                features['span_name'] = span.get('name', '')
-                features['span_kind'] = span.get('kind', 0)  # 1=Internal, 2=Server, 3=Client, 4=Producer, 5=Consumer
+    class TracesData(msgspec.Struct, rename='camel', gc=False):
+        resource_spans: list[ResourceSpans] = []
 
-                # HTTP attributes - convert list to dict
-                attributes = {attr['key']: attr['value'] for attr in span.get('attributes', [])}
+    decode = msgspec.json.Decoder(TracesData).decode
+    fields = {'stringValue': 'string_value', 'intValue': 'int_value'}
+    slots = {key: (i, fields[field], default) for key, (i, field, default) in ATTRIBUTE_SLOTS.items()}
 
-                features['http_method'] = attributes.get('http.method', {}).get('stringValue', '')
-                features['http_status_code'] = attributes.get('http.status_code', {}).get('intValue', 0)
-                features['http_target'] = attributes.get('http.target', {}).get('stringValue', '')
-                features['http_url'] = attributes.get('http.url', {}).get('stringValue', '')
+    def rows(line):
+        try:
+            trace = decode(line)
+        except msgspec.MsgspecError:
+            return extract_trace_features(json.loads(line.strip()))
 
-                # Anomaly labels (extracted from custom headers)
-                features['anomaly_type'] = attributes.get('anomaly.type', {}).get('stringValue', 'none')
-                features['anomaly_label'] = attributes.get('anomaly.label', {}).get('stringValue', 'normal')
-                features['anomaly_root_cause'] = attributes.get('anomaly.root_cause', {}).get('stringValue', 'none')
-                features['anomaly_msg'] = attributes.get('anomaly.msg', {}).get('stringValue', '')
+        rows = []
+        for resource_span in trace.resource_spans:
+            service_name = 'unknown'
+            for attr in resource_span.resource.attributes:
+                if attr.key == 'service.name':
+                    value = attr.value.string_value
+                    service_name = 'unknown' if value is UNSET else value
+                    break
 
-                # Span status
-                features['span_status'] = span.get('status', {}).get('code', 0)
-                features['span_status_message'] = span.get('status', {}).get('message', '')
+            for scope_span in resource_span.scope_spans:
+                for span in scope_span.spans:
+                    values = ATTRIBUTE_DEFAULTS.copy()
+                    for attr in span.attributes:
+                        slot = slots.get(attr.key)
+                        if slot is not None:
+                            value = getattr(attr.value, slot[1])
+                            values[slot[0]] = slot[2] if value is UNSET else value
 
-                # Network attributes
-                features['net_peer_name'] = attributes.get('net.peer.name', {}).get('stringValue', '')
-                features['net_peer_port'] = attributes.get('net.peer.port', {}).get('intValue', 0)
+                    rows.append((
+                        int(span.start_time_unix_nano),
+                        int(span.end_time_unix_nano),
+                        service_name,
+                        span.trace_id,
+                        span.span_id,
+                        span.parent_span_id,
+                        span.name,
+                        span.kind,
+                        span.status.code,
+                        span.status.message,
+                        *values,
+                    ))
+        return rows
 
-                # Add any custom tags
-                features['datacenter'] = attributes.get('custom.sdk.tags.datacenter', {}).get('stringValue', '')
+    return rows
 
-                all_span_features.append(features)
+def orjson_trace_rows():
+    """extract_trace_features() of lines decoded by orjson, None without it"""
+    try:
+        import orjson
+    except ImportError:
+        return None
 
-    return all_span_features
+    def rows(line):
+        try:
+            trace = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # json for the same warning text
+            trace = json.loads(line.strip())
+        return extract_trace_features(trace)
+
+    return rows
+
+def json_trace_rows(line):
+    return extract_trace_features(json.loads(line.strip()))
+
+DECODERS = ('auto', 'msgspec', 'orjson', 'json')
+
+@lru_cache(maxsize=None)
+def trace_decoder(name='auto'):
+    """rows(line) for one JSONL line of traces, using the decoder asked for
+
+    auto takes the fastest one installed: msgspec, orjson, then json.
+    """
+    if name == 'json':
+        return json_trace_rows
+    for candidate, make in (('msgspec', msgspec_trace_rows), ('orjson', orjson_trace_rows)):
+        if name in ('auto', candidate):
+            rows = make()
+            if rows is not None:
+                return rows
+            if name == candidate:
+                sys.exit(f"Error: --decoder {name} needs {name} (pip install {name})")
+    return json_trace_rows
 
 def extract_metric_features(metric_line):
     """Extract features from a single metric datapoint"""
@@ -137,82 +267,704 @@ def extract_metric_features(metric_line):
 
     return features
 
-def process_traces(input_file, output_dir):
-    """Process traces JSONL file and create labeled dataset"""
-    all_spans = []
-    trace_count = 0
+# Columns of the trace datasets
+TRACE_COLUMNS = [
+    'timestamp', 'start_time_ns', 'end_time_ns', 'duration_ns', 'duration_ms',
+    'service_name', 'trace_id', 'span_id', 'parent_span_id', 'span_name', 'span_kind',
+    'http_method', 'http_status_code', 'http_target', 'http_url',
+    'anomaly_type', 'anomaly_label', 'anomaly_root_cause', 'anomaly_msg',
+    'span_status', 'span_status_message', 'net_peer_name', 'net_peer_port', 'datacenter',
+]
 
-    print(f"Reading traces from {input_file}...")
-    with open(input_file, 'r') as f:
-        for line_num, line in enumerate(f, 1):
-            try:
-                trace = json.loads(line.strip())
-                span_features_list = extract_trace_features(trace)
-                if span_features_list:
-                    all_spans.extend(span_features_list)  # Add all spans from this trace
-                    trace_count += 1
-            except json.JSONDecodeError as e:
-                print(f"Warning: Skipping invalid JSON at line {line_num}: {e}")
-            except Exception as e:
-                print(f"Warning: Error processing line {line_num}: {e}")
+# Spans held in memory before they are written out
+BATCH_SIZE = 100_000
+
+def unix_micros(ns):
+    """Microseconds since the epoch datetime.fromtimestamp(ns / 1_000_000_000) gives
+
+    In Python ns / 1_000_000_000 is the exact quotient rounded once to
+    a double, whose part below the second falls on a grid of
+    2**(e - 52) seconds for whole seconds in [2**e, 2**(e + 1)). That
+    part is rounded onto the grid with integer arithmetic, then half to
+    even to microseconds as fromtimestamp() does. Seconds below 2**20,
+    which are no real span times, are worked out in Python.
+    """
+    whole, rest = np.divmod(ns, 1_000_000_000)
+    micros = np.empty_like(ns)
+    fast = whole >= 2 ** 20
+    if fast.any():
+        seconds, rest = whole[fast], rest[fast]
+        exponent = np.frexp(seconds.astype('float64'))[1] - 1
+        steps = np.left_shift(np.int64(1), 52 - exponent)
+        # rest / 1e9 in grid steps, rounded half to even
+        grid, remainder = np.divmod(rest * steps, 1_000_000_000)
+        grid += (2 * remainder > 1_000_000_000) | ((2 * remainder == 1_000_000_000) & (grid % 2 == 1))
+        fraction = grid.astype('float64') / steps.astype('float64')
+        sub = np.rint(fraction * 1_000_000).astype('int64')
+        micros[fast] = seconds * 1_000_000 + sub
+    for i in np.flatnonzero(~fast):
+        fraction, seconds = math.modf(int(ns[i]) / 1_000_000_000)
+        micros[i] = int(seconds) * 1_000_000 + round(fraction * 1_000_000)
+    return micros
+
+def local_times(ns):
+    """datetime.fromtimestamp(ns / 1e9) of each value, as naive datetime64
+
+    Same microseconds as unix_micros() and the same local time offsets,
+    looked up once per distinct second, so the times are the ones
+    converting a span at a time gave.
+    """
+    micros = unix_micros(ns.to_numpy(dtype='int64'))
+    distinct, index = np.unique(micros // 1_000_000, return_inverse=True)
+    offsets = np.array([time.localtime(second).tm_gmtoff for second in distinct.tolist()], dtype='int64')
+    return (micros + offsets[index] * 1_000_000).astype('datetime64[us]')
+
+def iso_times(times):
+    """datetime.isoformat() of each naive datetime64, for the CSVs"""
+    values = times.to_numpy(dtype='datetime64[us]')
+    text = pd.Series(np.datetime_as_string(values, unit='us'), index=times.index)
+    whole = values.astype('int64') % 1_000_000 == 0
+    text[whole] = text[whole].str[:19]
+    return text
+
+def spans_frame(rows):
+    """DataFrame with TRACE_COLUMNS of extract_trace_features() rows"""
+    df = pd.DataFrame.from_records(rows, columns=ROW_COLUMNS)
+    start = df['start_time_ns'].astype('int64')
+    df['timestamp'] = local_times(start)
+    df['duration_ns'] = df['end_time_ns'].astype('int64') - start
+    df['duration_ms'] = df['duration_ns'] / 1_000_000
+    return df[TRACE_COLUMNS]
+
+class CsvSink:
+    """One output CSV, appended to a batch at a time
+
+    With append, an existing file is added to rather than replaced.
+    """
+
+    def __init__(self, path, columns, append=False):
+        self.path = path
+        self.columns = columns
+        self.append = append
+        self.rows = 0
+        self._file = None
+
+    def _exists(self):
+        return self.append and self.path.exists() and self.path.stat().st_size > 0
+
+    def write(self, df):
+        if self._file is None:
+            exists = self._exists()
+            self._file = open(self.path, 'a' if exists else 'w', newline='')
+            df.to_csv(self._file, index=False, header=not exists)
+        else:
+            df.to_csv(self._file, index=False, header=False)
+        self.rows += len(df)
+
+    def close(self):
+        # an empty split still gets a file with the header
+        if self._file is None:
+            if self._exists():
+                return
+            self.write(pd.DataFrame(columns=self.columns))
+        self._file.close()
+
+# Output formats, --format
+FORMATS = ('csv', 'parquet', 'arrow')
 
-    print(f"Extracted {len(all_spans)} spans from {trace_count} traces")
-
-    # Convert to DataFrame
-    df = pd.DataFrame(all_spans)
-
-    # Summary statistics
-    print("\n=== Dataset Summary ===")
-    print(f"Total spans: {len(df)}")
-    print(f"Unique traces: {df['trace_id'].nunique()}")
-    print(f"\nService distribution:")
-    print(df['service_name'].value_counts())
-    print(f"\nLabel distribution:")
-    print(df['anomaly_label'].value_counts())
-    print(f"\nAnomaly types:")
-    print(df['anomaly_type'].value_counts())
-
-    # Span relationship analysis
-    print(f"\nSpan relationships:")
-    print(f"  Root spans (no parent): {df['parent_span_id'].isna().sum() + (df['parent_span_id'] == '').sum()}")
-    print(f"  Child spans (has parent): {(df['parent_span_id'] != '').sum() - df['parent_span_id'].isna().sum()}")
-
-    # Save full dataset
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_file = output_dir / f'traces_labeled_{timestamp}.csv'
-    df.to_csv(output_file, index=False)
-    print(f"\nSaved full dataset to: {output_file}")
-
-    # Save separate normal and anomalous datasets
-    normal_df = df[df['anomaly_label'] == 'normal']
-    anomalous_df = df[df['anomaly_label'] == 'anomalous']
-
-    normal_file = output_dir / f'traces_normal_{timestamp}.csv'
-    anomalous_file = output_dir / f'traces_anomalous_{timestamp}.csv'
-
-    normal_df.to_csv(normal_file, index=False)
-    anomalous_df.to_csv(anomalous_file, index=False)
-
-    print(f"Saved normal dataset ({len(normal_df)} spans from {normal_df['trace_id'].nunique()} traces) to: {normal_file}")
-    print(f"Saved anomalous dataset ({len(anomalous_df)} spans from {anomalous_df['trace_id'].nunique()} traces) to: {anomalous_file}")
-
-    # Save by anomaly type
-    for anomaly_type in df['anomaly_type'].unique():
-        if anomaly_type != 'none':
-            type_df = df[df['anomaly_type'] == anomaly_type]
-            type_file = output_dir / f'traces_{anomaly_type}_{timestamp}.csv'
-            type_df.to_csv(type_file, index=False)
-            print(f"Saved {anomaly_type} dataset ({len(type_df)} samples) to: {type_file}")
+# Compression of Parquet and Arrow files
+COMPRESSION = 'zstd'
 
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        sys.exit("Error: --format parquet and --format arrow need pyarrow (pip install pyarrow)")
+    return pyarrow
+
+def trace_schema(pa):
+    """Types of the trace columns in Parquet and Arrow files
+
+    Times are int64 nanoseconds, timestamp is the same local time the
+    CSV has. Labels, services and the ids that repeat across spans are
+    dictionary encoded, so they load as pandas categoricals.
+    """
+    category = pa.dictionary(pa.int32(), pa.string())
+    types = {
+        'timestamp': pa.timestamp('ns'),
+        'start_time_ns': pa.int64(),
+        'end_time_ns': pa.int64(),
+        'duration_ns': pa.int64(),
+        'duration_ms': pa.float64(),
+        'service_name': category,
+        'trace_id': category,
+        'span_id': pa.string(),
+        'parent_span_id': category,
+        'span_name': category,
+        'span_kind': pa.int8(),
+        'http_method': category,
+        'http_status_code': pa.int32(),
+        'http_target': pa.string(),
+        'http_url': pa.string(),
+        'anomaly_type': category,
+        'anomaly_label': category,
+        'anomaly_root_cause': category,
+        'anomaly_msg': category,
+        'span_status': pa.int8(),
+        'span_status_message': category,
+        'net_peer_name': category,
+        'net_peer_port': pa.int32(),
+        'datacenter': category,
+    }
+    return pa.schema([(name, types[name]) for name in TRACE_COLUMNS])
+
+def typed_frame(df, schema, pa):
+    """df with the column types schema expects
+
+    OTLP JSON has int64 attribute values as strings.
+    """
+    df = df.copy()
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            df[field.name] = pd.to_numeric(df[field.name]).astype('int64')
     return df
 
-def process_metrics(input_file, output_dir):
-    """Process metrics JSONL file"""
+class ColumnarSink:
+    """One Parquet or Arrow IPC file, appended to a batch at a time
+
+    Parquet gets a row group per batch. An Arrow file can only add to a
+    dictionary, never replace it, so the dictionaries are kept for the
+    whole file and each batch is encoded against them.
+    """
+
+    def __init__(self, path, schema, fmt):
+        self.path = path
+        self.schema = schema
+        self.format = fmt
+        self.rows = 0
+        self._writer = None
+        pa = import_pyarrow()
+        self._dictionaries = {field.name: [] for field in schema if pa.types.is_dictionary(field.type)}
+
+    def _table(self, df):
+        pa = import_pyarrow()
+        if self.format == 'parquet':
+            return pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        columns = []
+        for field in self.schema:
+            values = df[field.name]
+            if field.name in self._dictionaries:
+                dictionary = self._dictionaries[field.name]
+                new = pd.Index(values.unique()).difference(dictionary, sort=False)
+                dictionary.extend(new)
+                codes = pd.Categorical(values, categories=dictionary).codes.astype('int32')
+                columns.append(pa.DictionaryArray.from_arrays(codes, pa.array(dictionary, pa.string())))
+            else:
+                columns.append(pa.array(values, type=field.type, from_pandas=True))
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def _open(self):
+        pa = import_pyarrow()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetWriter(self.path, self.schema, compression=COMPRESSION)
+        options = pa.ipc.IpcWriteOptions(compression=COMPRESSION, emit_dictionary_deltas=True)
+        return pa.ipc.new_file(self.path, self.schema, options=options)
+
+    def write(self, df):
+        table = self._table(df)
+        if self._writer is None:
+            self._writer = self._open()
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+class TraceCounts:
+    """Running totals for the dataset summary
+
+    Only trace ids are kept, as 64 bit ints, to count unique traces.
+    """
+
+    def __init__(self):
+        self.spans = 0
+        self.roots = 0
+        self.services = Counter()
+        self.labels = Counter()
+        self.anomaly_types = Counter()
+        self.traces = set()
+        self.traces_by_label = defaultdict(set)
+
+    @staticmethod
+    def _trace_keys(trace_ids):
+        return {hash(trace_id) for trace_id in trace_ids}
+
+    def add(self, df):
+        self.spans += len(df)
+        self.roots += int((df['parent_span_id'] == '').sum() + df['parent_span_id'].isna().sum())
+        self.services.update(df['service_name'].value_counts().to_dict())
+        self.labels.update(df['anomaly_label'].value_counts().to_dict())
+        self.anomaly_types.update(df['anomaly_type'].value_counts().to_dict())
+        self.traces |= self._trace_keys(df['trace_id'])
+        for label, part in df.groupby('anomaly_label', sort=False):
+            self.traces_by_label[label] |= self._trace_keys(part['trace_id'])
+
+    @staticmethod
+    def _series(counter, name):
+        return pd.Series(counter, name='count', dtype='int64').rename_axis(name).sort_values(ascending=False, kind='stable')
+
+    def print_summary(self):
+        print("\n=== Dataset Summary ===")
+        print(f"Total spans: {self.spans}")
+        print(f"Unique traces: {len(self.traces)}")
+        print(f"\nService distribution:")
+        print(self._series(self.services, 'service_name'))
+        print(f"\nLabel distribution:")
+        print(self._series(self.labels, 'anomaly_label'))
+        print(f"\nAnomaly types:")
+        print(self._series(self.anomaly_types, 'anomaly_type'))
+
+        # Span relationship analysis
+        print(f"\nSpan relationships:")
+        print(f"  Root spans (no parent): {self.roots}")
+        print(f"  Child spans (has parent): {self.spans - self.roots}")
+
+class TraceDataset:
+    """Trace datasets, fed a batch of spans at a time
+
+    Every batch is routed to the outputs as it arrives, so memory use
+    depends on the batch size, not on the input. Subclasses route(df).
+    """
+
+    def __init__(self, output_dir, timestamp, checkpoint):
+        self.output_dir = output_dir
+        # no timestamp: the datasets incremental runs add to
+        self.suffix = f'_{timestamp}' if timestamp else ''
+        self.checkpoint = checkpoint
+        self.part = checkpoint.part if checkpoint is not None else 0
+        self.counts = TraceCounts()
+
+    def write(self, spans):
+        if spans:
+            self.write_frame(spans_frame(spans))
+
+    def write_frame(self, df):
+        if df.empty:
+            return
+        self.counts.add(df)
+        self.route(df)
+
+class CsvTraceDataset(TraceDataset):
+    """The full, normal, anomalous and per anomaly_type CSVs"""
+
+    def __init__(self, output_dir, timestamp, checkpoint):
+        super().__init__(output_dir, timestamp, checkpoint)
+        self.full = self._sink('labeled')
+        self.normal = self._sink('normal')
+        self.anomalous = self._sink('anomalous')
+        self.by_type = {}
+
+    def _sink(self, name):
+        path = self.output_dir / f'traces_{name}{self.suffix}.csv'
+        # only CSVs a completed run wrote are added to, see Checkpoint.rollback()
+        return CsvSink(path, TRACE_COLUMNS, self.checkpoint is not None and path.name in self.checkpoint.outputs)
+
+    def route(self, df):
+        df = df.assign(timestamp=iso_times(df['timestamp']))
+        self.full.write(df)
+        labels = df['anomaly_label']
+        self.normal.write(df[labels == 'normal'])
+        self.anomalous.write(df[labels == 'anomalous'])
+        for anomaly_type, part in df.groupby('anomaly_type', sort=False):
+            if anomaly_type != 'none':
+                if anomaly_type not in self.by_type:
+                    self.by_type[anomaly_type] = self._sink(anomaly_type)
+                self.by_type[anomaly_type].write(part)
+
+    def close(self):
+        for sink in (self.full, self.normal, self.anomalous, *self.by_type.values()):
+            sink.close()
+            if self.checkpoint is not None:
+                self.checkpoint.wrote(sink.path)
+
+    def print_saved(self):
+        traces = self.counts.traces_by_label
+        print(f"\nSaved full dataset to: {self.full.path}")
+        print(f"Saved normal dataset ({self.normal.rows} spans from {len(traces['normal'])} traces) to: {self.normal.path}")
+        print(f"Saved anomalous dataset ({self.anomalous.rows} spans from {len(traces['anomalous'])} traces) to: {self.anomalous.path}")
+        for anomaly_type, sink in self.by_type.items():
+            print(f"Saved {anomaly_type} dataset ({sink.rows} samples) to: {sink.path}")
+
+class PartitionedTraceDataset(TraceDataset):
+    """One Parquet or Arrow dataset, partitioned by anomaly_type
+
+    Each span is stored once, under traces_<timestamp>/anomaly_type=<type>/,
+    the hive layout pyarrow and pandas read back as one table with the
+    anomaly_type column. Normal and anomalous are a filter on anomaly_label.
+    """
+
+    def __init__(self, output_dir, timestamp, checkpoint, fmt):
+        super().__init__(output_dir, timestamp, checkpoint)
+        pa = import_pyarrow()
+        self.format = fmt
+        self.path = output_dir / f'traces{self.suffix}'
+        self.schema = trace_schema(pa)
+        self._file_schema = self.schema.remove(self.schema.get_field_index('anomaly_type'))
+        self.parts = {}
+
+    def route(self, df):
+        df = typed_frame(df, self.schema, import_pyarrow())
+        for anomaly_type, part in df.groupby('anomaly_type', sort=False):
+            if anomaly_type not in self.parts:
+                directory = self.path / f"anomaly_type={quote(str(anomaly_type), safe='')}"
+                self.parts[anomaly_type] = ColumnarSink(directory / f'part-{self.part}.{self.format}', self._file_schema, self.format)
+            self.parts[anomaly_type].write(part.drop(columns='anomaly_type'))
+
+    def close(self):
+        for sink in self.parts.values():
+            sink.close()
+
+    def print_saved(self):
+        traces = self.counts.traces_by_label
+        print(f"\nSaved {self.format} dataset ({self.counts.spans} spans) to: {self.path}")
+        for label in ('normal', 'anomalous'):
+            print(f"  {label}: {self.counts.labels[label]} spans from {len(traces[label])} traces")
+        for anomaly_type, sink in self.parts.items():
+            print(f"  anomaly_type={anomaly_type}: {sink.rows} spans")
+
+def open_trace_dataset(output_dir, fmt, timestamp=None, checkpoint=None):
+    """The datasets of one run, named by timestamp
+
+    Without a timestamp they are the ones --incremental adds to: CSVs
+    are appended to and Parquet/Arrow get part-<part> files, <part>
+    coming from the checkpoint.
+    """
+    if fmt == 'csv':
+        return CsvTraceDataset(output_dir, timestamp, checkpoint)
+    return PartitionedTraceDataset(output_dir, timestamp, checkpoint, fmt)
+
+class ReadStats:
+    def __init__(self, lines=0):
+        self.lines = lines
+        self.traces = 0
+
+def print_line_warning(line_num, error):
+    if isinstance(error, json.JSONDecodeError):
+        print(f"Warning: Skipping invalid JSON at line {line_num}: {error}")
+    else:
+        print(f"Warning: Error processing line {line_num}: {error}")
+
+def read_span_batches(f, end, batch_size, stats, warn, decode):
+    """Spans of the JSONL lines in f up to byte offset end, batch_size at a time
+
+    f is opened in binary mode and decode is one of trace_decoder()'s;
+    stats.lines and stats.traces are kept up to date and
+    warn(line_in_range, error) is called for bad lines.
+    """
+    batch = []
+    pos = f.tell()
+    for line in f:
+        pos += len(line)
+        stats.lines += 1
+        try:
+            span_features_list = decode(line)
+            if span_features_list:
+                batch.extend(span_features_list)  # Add all spans from this trace
+                stats.traces += 1
+        except Exception as e:
+            warn(stats.lines, e)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+        if end is not None and pos >= end:
+            break
+    if batch:
+        yield batch
+
+# Bytes of input per task with --workers, the most each worker holds at once
+CHUNK_BYTES = 32 * 1024 * 1024
+
+def chunk_ranges(input_file, chunk_bytes, start=0, end=None):
+    """(start, end) byte ranges covering the file from start to end, each ending after a newline"""
+    size = Path(input_file).stat().st_size if end is None else end
+    with open(input_file, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+def parse_chunk(input_file, start, end, decoder):
+    """Worker side of --workers: one byte range as a single DataFrame
+
+    Warnings come back with line numbers counted from the start of the
+    range, the caller adds the lines of the ranges before it.
+    """
+    stats = ReadStats()
+    warnings = []
+    frames = []
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        for batch in read_span_batches(f, end, BATCH_SIZE, stats, lambda n, e: warnings.append((n, e)),
+                                       trace_decoder(decoder)):
+            frames.append(spans_frame(batch))
+    df = pd.concat(frames, ignore_index=True) if frames else None
+    return df, stats.lines, stats.traces, warnings
+
+def parse_parallel(input_file, dataset, workers, stats, decoder, start=0, end=None):
+    """Feed dataset the chunks of input_file parsed in a process pool
+
+    Results are taken in file order, so the output is the same as the
+    serial path. Only a couple of chunks per worker are in flight.
+    """
+    size = (Path(input_file).stat().st_size if end is None else end) - start
+    chunk_bytes = max(1024 * 1024, min(CHUNK_BYTES, -(-size // (workers * 4))))
+
+    def take(future):
+        df, lines, traces, warnings = future.result()
+        for line_num, error in warnings:
+            print_line_warning(stats.lines + line_num, error)
+        stats.lines += lines
+        stats.traces += traces
+        if df is not None:
+            dataset.write_frame(df)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk_start, chunk_end in chunk_ranges(input_file, chunk_bytes, start, end):
+            pending.append(pool.submit(parse_chunk, input_file, chunk_start, chunk_end, decoder))
+            if len(pending) >= workers * 2:
+                take(pending.popleft())
+        while pending:
+            take(pending.popleft())
+
+# Bytes at the start of a file whose hash tells a rewritten file from a grown one
+HEAD_BYTES = 4096
+
+def head_digest(input_file, length):
+    with open(input_file, 'rb') as f:
+        return hashlib.sha1(f.read(length)).hexdigest()
+
+def last_line_end(input_file, start):
+    """Offset just past the last newline in input_file, start if there is none after it
+
+    A line the collector is still writing is left for the next run.
+    """
+    with open(input_file, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > start:
+            block = max(start, end - 64 * 1024)
+            f.seek(block)
+            newline = f.read(end - block).rfind(b'\n')
+            if newline >= 0:
+                return block + newline + 1
+            end = block
+    return start
+
+class Checkpoint:
+    """How far --incremental runs got in each input file
+
+    Kept as JSON in the output directory: the byte offset after the last
+    line read, the line count for warnings, and the file's inode and a
+    hash of its first bytes. A new inode means the file was rotated, a
+    smaller size or another hash that it was truncated or rewritten; it
+    is then read again from the start. It is saved after the outputs are
+    closed, so a run that dies before that is redone by the next one,
+    after rollback() has removed what it wrote.
+    """
+
+    FILE = '.extract-checkpoint.json'
+    # directories of the Parquet/Arrow part files
+    PART_DIRS = ('traces', 'metrics_labeled')
+
+    def __init__(self, output_dir):
+        self.path = output_dir / self.FILE
+        self.state = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.state = json.load(f)
+        # part number of the Parquet/Arrow files written by this run
+        self.part = self.state.get('part', 0)
+        # size of each appended CSV as the last completed run left it
+        self.outputs = self.state.get('outputs', {})
+        self._written = {}
+        self._advanced = False
+
+    def rollback(self):
+        """Remove what a run that did not save the checkpoint wrote
+
+        Appended CSVs are cut back to their saved sizes and the part files
+        of the unsaved part deleted, so reading its lines again does not
+        add them twice. CSVs missing from the checkpoint are rewritten.
+        """
+        for name, size in self.outputs.items():
+            path = self.path.parent / name
+            if path.exists() and path.stat().st_size > size:
+                print(f"Removing rows of an unfinished run from {path}")
+                os.truncate(path, size)
+        for directory in self.PART_DIRS:
+            for path in (self.path.parent / directory).glob(f'**/part-{self.part}.*'):
+                path.unlink()
+
+    def resume(self, key, input_file):
+        """(offset, lines) to carry on from in input_file, None if it is missing"""
+        try:
+            st = os.stat(input_file)
+        except FileNotFoundError:
+            print(f"Waiting for {input_file}")
+            return None
+        saved = self.state.get(key)
+        if saved is None:
+            return 0, 0
+        # the same file however its path is spelled or if it was renamed
+        if (saved['inode'], saved['device']) != (st.st_ino, st.st_dev):
+            if Path(saved['path']).resolve() != Path(input_file).resolve():
+                return 0, 0
+            print(f"{input_file} was rotated, reading it from the start")
+            self._warn_unread(saved, Path(input_file).resolve().parent)
+            return 0, 0
+        if st.st_size < saved['offset'] or head_digest(input_file, saved['head_bytes']) != saved['head']:
+            print(f"{input_file} was truncated, reading it from the start")
+            return 0, 0
+        return saved['offset'], saved['lines']
+
+    def _warn_unread(self, saved, directory):
+        """Say how much of a rotated file was written after the last run read it"""
+        for entry in os.scandir(directory):
+            if entry.inode() == saved['inode'] and entry.stat().st_dev == saved['device']:
+                unread = entry.stat().st_size - saved['offset']
+                if unread > 0:
+                    print(f"Warning: {unread} bytes added to {entry.path} before it was rotated were not read")
+                return
+        print(f"Warning: rotated {saved['path']} not found, any lines added to it after byte "
+              f"{saved['offset']} were not read")
+
+    def advance(self, key, input_file, offset, lines):
+        st = os.stat(input_file)
+        head_bytes = min(offset, HEAD_BYTES)
+        self.state[key] = {
+            'path': str(Path(input_file).resolve()),
+            'inode': st.st_ino,
+            'device': st.st_dev,
+            'offset': offset,
+            'lines': lines,
+            'head_bytes': head_bytes,
+            'head': head_digest(input_file, head_bytes),
+        }
+        self._advanced = True
+
+    def wrote(self, path):
+        self._written[path.name] = path.stat().st_size
+
+    def save(self):
+        if not self._advanced:
+            return
+        self.part += 1
+        self.state['part'] = self.part
+        self.outputs.update(self._written)
+        self._written = {}
+        self.state['outputs'] = self.outputs
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.path)
+        self._advanced = False
+
+def process_traces(input_file, output_dir, batch_size=BATCH_SIZE, workers=1, fmt='csv', decoder='auto',
+                   checkpoint=None):
+    """Process traces JSONL file and create labeled dataset
+
+    Streams the file: spans are written out every batch_size spans and
+    only running totals are kept for the summary. With workers > 1 the
+    file is parsed in byte ranges by a process pool. With a checkpoint
+    only the lines added since the last run are read, into the datasets
+    incremental runs add to.
+    """
+    start, end, stats = 0, None, ReadStats()
+    if checkpoint is None:
+        dataset = open_trace_dataset(output_dir, fmt, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    else:
+        position = checkpoint.resume('traces', input_file)
+        if position is None:
+            return None
+        start, lines = position
+        end = last_line_end(input_file, start)
+        if end == start:
+            print(f"No new traces in {input_file}")
+            return None
+        stats = ReadStats(lines)
+        dataset = open_trace_dataset(output_dir, fmt, checkpoint=checkpoint)
+
+    print(f"Reading traces from {input_file}...")
+    if workers > 1:
+        parse_parallel(input_file, dataset, workers, stats, decoder, start, end)
+    else:
+        with open(input_file, 'rb') as f:
+            f.seek(start)
+            for batch in read_span_batches(f, end, batch_size, stats, print_line_warning, trace_decoder(decoder)):
+                dataset.write(batch)
+    dataset.close()
+    if checkpoint is not None:
+        checkpoint.advance('traces', input_file, end, stats.lines)
+
+    print(f"Extracted {dataset.counts.spans} spans from {stats.traces} traces")
+    dataset.counts.print_summary()
+    dataset.print_saved()
+
+    return dataset.counts
+
+def write_metrics_table(df, output_file, fmt):
+    """Metrics as a typed Parquet or Arrow file
+
+    Metric values are numbers (OTLP JSON has int64 ones as strings),
+    service_name and anomaly_label are dictionary encoded.
+    """
+    pa = import_pyarrow()
+    df = df.copy()
+    for column in df.columns:
+        if column in ('service_name', 'anomaly_label'):
+            df[column] = df[column].astype('category')
+        else:
+            df[column] = pd.to_numeric(df[column])
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, output_file, compression=COMPRESSION)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, output_file, compression=COMPRESSION)
+
+def process_metrics(input_file, output_dir, fmt='csv', checkpoint=None):
+    """Process metrics JSONL file
+
+    With a checkpoint only the lines added since the last run are read,
+    and saved as metrics_labeled/part-<part>.<fmt>.
+    """
     metrics = []
+    start, end, line_num = 0, None, 0
+    if checkpoint is not None:
+        position = checkpoint.resume('metrics', input_file)
+        if position is None:
+            return None
+        start, line_num = position
+        end = last_line_end(input_file, start)
+        if end == start:
+            print(f"\nNo new metrics in {input_file}")
+            return None
 
     print(f"\nReading metrics from {input_file}...")
-    with open(input_file, 'r') as f:
-        for line_num, line in enumerate(f, 1):
+    with open(input_file, 'rb') as f:
+        pos = f.seek(start)
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            line_num += 1
             try:
                 metric = json.loads(line.strip())
                 features = extract_metric_features(metric)
@@ -225,15 +977,39 @@ def process_metrics(input_file, output_dir):
 
     print(f"Extracted {len(metrics)} metric datapoints")
 
+    df = None
     if metrics:
         df = pd.DataFrame(metrics)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_file = output_dir / f'metrics_labeled_{timestamp}.csv'
-        df.to_csv(output_file, index=False)
+        if checkpoint is None:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            output_file = output_dir / f'metrics_labeled_{timestamp}.{fmt}'
+        else:
+            # metric columns differ between runs, so each run gets its own part
+            output_file = output_dir / 'metrics_labeled' / f'part-{checkpoint.part}.{fmt}'
+            output_file.parent.mkdir(exist_ok=True)
+        if fmt == 'csv':
+            df.to_csv(output_file, index=False)
+        else:
+            write_metrics_table(df, output_file, fmt)
         print(f"Saved metrics dataset to: {output_file}")
-        return df
 
-    return None
+    if checkpoint is not None:
+        checkpoint.advance('metrics', input_file, end, line_num)
+    return df
+
+def extract(args, checkpoint=None):
+    if checkpoint is not None:
+        checkpoint.rollback()
+
+    if args.traces:
+        process_traces(args.traces, args.output, args.batch_size, args.workers, args.format, args.decoder,
+                       checkpoint)
+
+    if args.metrics:
+        process_metrics(args.metrics, args.output, args.format, checkpoint)
+
+    if checkpoint is not None:
+        checkpoint.save()
 
 def main():
     parser = argparse.ArgumentParser(description='Extract labeled dataset from OTEL traces/metrics')
@@ -241,23 +1017,43 @@ def main():
     parser.add_argument('--metrics', type=Path, help='Path to metrics JSONL file')
     parser.add_argument('--output', type=Path, default=Path('./dataset'),
                         help='Output directory for datasets (default: ./dataset)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help=f'Spans held in memory before writing (default: {BATCH_SIZE})')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes parsing the traces file (default: 1)')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help='Output format; parquet and arrow write one typed, compressed '
+                             'trace dataset partitioned by anomaly_type (default: csv)')
+    parser.add_argument('--decoder', choices=DECODERS, default='auto',
+                        help='JSON decoder for traces; auto uses msgspec or orjson when installed (default: auto)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only read lines added since the last --incremental run into this --output, '
+                             f'and add them to untimestamped datasets; progress is kept in {Checkpoint.FILE}')
+    parser.add_argument('--follow', type=float, metavar='SECONDS',
+                        help='Run --incremental every SECONDS until interrupted, e.g. during a k6 run')
 
     args = parser.parse_args()
 
-    # Create output directory
-    args.output.mkdir(parents=True, exist_ok=True)
-
-    if args.traces:
-        process_traces(args.traces, args.output)
-
-    if args.metrics:
-        process_metrics(args.metrics, args.output)
-
     if not args.traces and not args.metrics:
         print("Error: Please provide --traces and/or --metrics file path")
         parser.print_help()
         return 1
 
+    # Create output directory
+    args.output.mkdir(parents=True, exist_ok=True)
+
+    if args.follow:
+        checkpoint = Checkpoint(args.output)
+        while True:
+            extract(args, checkpoint)
+            # stopping in a run leaves it to the next one, which rolls it back
+            try:
+                time.sleep(args.follow)
+            except KeyboardInterrupt:
+                break
+    else:
+        extract(args, Checkpoint(args.output) if args.incremental else None)
+
     print("\n=== Extraction Complete ===")
     return 0
 